@@ -1,9 +1,16 @@
 
+import weakref
+
 '''
 User Class
 - Stores information about a user such as the ID and name
+- Slotted, and users are interned by ID so every message from the same user shares one User object
 '''
 class User:
+    __slots__ = ("name", "id", "__weakref__")
+
+    interned = weakref.WeakValueDictionary()
+
     def __init__(self, name: str):
         self.name = name
         self.id = -1
@@ -26,23 +33,46 @@ class User:
 
         return user
 
+    '''
+    Returns the shared user with the given ID, creating it if there isn't one
+    '''
+    @classmethod
+    def intern(cls, user_id: int, name: str):
+        user = cls.interned.get(user_id)
+
+        if user is None or user.name != name:
+            user = User(name)
+            user.id = user_id
+            cls.interned[user_id] = user
+
+        return user
+
 '''
 Message Class
 - Stores information about a message such as the ID, the content of the message and the user that sent it
+- attachment: The hash, name and size of the file attached to the message, or None
 '''
 class Message:
+    __slots__ = ("content", "sender", "id", "attachment")
+
     def __init__(self, content: str, sender: User):
         self.content = content
         self.sender = sender
         self.id = -1
+        self.attachment = None
 
     def build_json(self):
-        return {
+        data = {
             "id": self.id,
             "content": self.content,
             "sender": self.sender.build_json()
         }
 
+        if self.attachment is not None:
+            data["attachment"] = self.attachment
+
+        return data
+
     def build_packet(self):
         data = self.build_json()
         data["header"] = "message"
@@ -50,9 +80,10 @@ class Message:
         return data
 
     def from_packet(packet: dict):
-        sender = User.from_packet(packet["sender"])
+        sender = User.intern(packet["sender"]["id"], packet["sender"]["name"])
         message = Message(packet["content"], sender)
         message.id = packet["id"]
+        message.attachment = packet.get("attachment")
 
         return message
 
@@ -62,6 +93,8 @@ Announcement Class
 inform all connected clients of this
 '''
 class Announcement:
+    __slots__ = ("content",)
+
     def __init__(self, content: str):
         self.content = content
 
@@ -84,8 +117,42 @@ Constants
 - SYSTEM_USER: The user which will be used when making system messages
 - SERVER_USER: The user which will be used when making server announcements
 - SERVER_DISCONNECTION_MESSAGE: The message text which will be displayed when the server disconnects
+- SERVER_RECONNECT_MESSAGE: The message text which will be displayed once the client has reconnected
+- SERVER_TIMEOUT: How many seconds the server can go without sending anything, pings included, before it is treated
+as disconnected
+- SEARCH_COMMAND: Text typed into the typebox which starts with this is sent as a search query instead of a message
+- DIRECT_MESSAGE_COMMAND: Text typed into the typebox which starts with this is sent privately to the user named
+after it
+- ATTACH_COMMAND: Typing this into the typebox picks a file to upload, the rest of the text is sent along with it
+- DOWNLOAD_COMMAND: Text typed into the typebox which starts with this downloads the newest attachment with the file
+name after it
+- PARTIAL_SUFFIX: Added to the name of a file while it is being downloaded, an interrupted download resumes from it
+- TRANSFER_CHUNK_SIZE: How many bytes of an attachment are hashed or received at a time
+- RECONNECT_BASE_DELAY: The longest wait in seconds before the first attempt to reconnect, it doubles after every
+failed attempt
+- RECONNECT_MAX_DELAY: The most the wait before an attempt to reconnect can grow to
+- RENDER_INTERVAL: How many milliseconds the user interface waits between drawing batches of events
+- RENDER_BATCH: The most events the user interface draws in a single batch
+- CHAT_VIEW_LINES: The most lines the chatbox holds at once, older lines are dropped from the chatbox but the
+messages stay cached
+- MESSAGE_CACHE_SIZE: The most messages a client keeps for its rooms, and for each conversation, unless another limit
+is set, older ones can be asked for again from the server
 '''
 SYSTEM_USER = User("System")
 SERVER_USER = User("Server")
-SERVER_DISCONNECT_MESSAGE = "Server is no longer online. Please try again later"
+SERVER_DISCONNECT_MESSAGE = "Server is no longer online. Reconnecting..."
+SERVER_RECONNECT_MESSAGE = "Reconnected to the server"
+SERVER_TIMEOUT = 60
+SEARCH_COMMAND = "/search "
+DIRECT_MESSAGE_COMMAND = "/msg "
+ATTACH_COMMAND = "/attach"
+DOWNLOAD_COMMAND = "/download "
+PARTIAL_SUFFIX = ".part"
+TRANSFER_CHUNK_SIZE = 1024 * 1024
+RECONNECT_BASE_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30
+RENDER_INTERVAL = 50
+RENDER_BATCH = 2000
+CHAT_VIEW_LINES = 500
+MESSAGE_CACHE_SIZE = 1000
 
@@ -2,29 +2,59 @@
 from tkinter.filedialog import *
 from tkinter import *
 from chatroom_objects import *
-from networking import *
+from sdk import ChatClient
 from threading import Thread
+from collections import deque
 import socket
+import queue
 import time
+import os
 
 '''
-ChatRoomClient Class, simple client which handles chat room events and the user interface
+ChatRoomClient Class, simple client which handles the user interface
+- The connection, the chat room state and the protocol are handled by a ChatClient from the client library, this
+class only draws what its events report
+- Events arrive on the connection's thread, which must never touch Tkinter, so they are queued and drawn in batches
+from the Tk event loop
 '''
-class ChatRoomClient(socket.socket, Tk):
+class ChatRoomClient(Tk):
     def __init__(self, ip: str, port: int, username: str):
-        socket.socket.__init__(self, socket.AF_INET, socket.SOCK_STREAM)
-        self.ip = ip
-        self.port = port
-        self.user = User(username)
-        self.users = []
-        self.messages = []
-
         Tk.__init__(self)
+        self.events = queue.SimpleQueue()
+        self.roster = []
+        self.pending_lines = []
+        self.notices = deque(maxlen = CHAT_VIEW_LINES)
+        self.rows = deque()
+        self.view_start = 0
+        self.following = True
+        self.showing_history = False
+        self.own_id = None
+        self.reconnecting = False
+        self.pending_attachments = {}
+
+        self.connection = ChatClient(ip, port, username)
+        self.connection.on_user_join = lambda user, room: self.events.put((self.draw_user, user))
+        self.connection.on_user_leave = lambda user, room: self.events.put((self.erase_user, user))
+        self.connection.on_message = lambda message, room: self.events.put((self.draw_message, message))
+        self.connection.on_announcement = lambda announcement, room: self.events.put((self.draw_announcement, announcement))
+        self.connection.on_users = lambda room: self.events.put((self.draw_users,))
+        self.connection.on_messages = lambda room: self.events.put((self.draw_history,))
+        self.connection.on_search = lambda query, messages, more, room: self.events.put((self.draw_search_results, query, messages, more))
+        self.connection.on_direct_message = lambda message, conversation: self.events.put((self.draw_direct_message, message))
+        self.connection.on_direct_message_ack = lambda ref, message_id, undelivered: self.events.put((self.direct_message_acknowledged, undelivered))
+        self.connection.on_attachment_uploaded = lambda digest, path: self.events.put((self.attachment_uploaded, digest, path))
+        self.connection.on_attachment_downloaded = lambda digest, path: self.events.put((self.draw_announcement, Announcement(f"Saved {os.path.basename(path)}")))
+        self.connection.on_attachment_failed = lambda digest: self.events.put((self.draw_announcement, Announcement("Attachment Transfer Failed")))
+        self.connection.on_rate_limited = lambda retry_after: self.events.put((self.rate_limited, retry_after))
+        self.connection.on_connect = lambda: self.events.put((self.connected,))
+        self.connection.on_disconnect = lambda: self.events.put((self.disconnected,))
+
         self.title("Chat Room App")
         self.geometry("750x500")
         self.resizable(False, False)
         self.draw_widgets()
         self.configure(background = "#303030")
+        self.after(RENDER_INTERVAL, self.render)
 
     '''
     Starts the client
@@ -33,128 +63,346 @@ class ChatRoomClient(socket.socket, Tk):
     def start(self):
         while True:
             try:
-                self.connect((self.ip, self.port))
+                self.connection.connect()
                 break
-            except:
+            except OSError:
                 time.sleep(2)
 
-        self.send_user()
-        Thread(target = self.socket_listener).start()
-
     '''
-    Receives data from the server
-    - Function which receives packets from the server and processes them
-    - Function only exits once the server disconnects
+    Draws the events queued by the connection, runs on the Tk event loop every render interval
+    - At most RENDER_BATCH events are drawn per tick so a busy room cannot freeze the user interface
+    - New chat lines are collected and inserted into the chatbox with a single call at the end of the batch
+    - The next tick is always scheduled, so an event which fails to draw cannot stop the user interface updating
     '''
-    def socket_listener(self):
-        while True:
-            try:
-                packet = DataTransfer.recv_packet(self, 4096)
-            except:
-                if not DataTransfer.socket_is_connected(self):
-                    self.draw_message(Message(SERVER_DISCONNECT_MESSAGE, SYSTEM_USER))
-                    self.disable_widgets()
+    def render(self):
+        try:
+            for _ in range(RENDER_BATCH):
+                try:
+                    draw, *args = self.events.get_nowait()
+                except queue.Empty:
                     break
 
-            if packet["header"] == "users":
-                self.users = []
+                draw(*args)
 
-                for user in packet["array"]:
-                    self.users.append(User.from_packet(user))
+            self.flush_lines()
+        finally:
+            self.after(RENDER_INTERVAL, self.render)
 
-                self.draw_users()
-            elif packet["header"] == "messages":
-                self.messages = []
+    '''
+    Inserts the chat lines collected during a batch, trimming the oldest lines so the chatbox never holds more than
+    CHAT_VIEW_LINES
+    - Lines are not shown while older messages are being viewed, the view jumps back to the newest messages when the
+    chatbox is scrolled down past the bottom
+    - Messages are redrawn from the connection's cache when the view jumps back, notices such as announcements and
+    direct messages are not cached there so they are held until then instead
+    - Whether each row of the chatbox is a message is tracked, so the window start only counts the message rows
+    '''
+    def flush_lines(self):
+        if not self.pending_lines:
+            return
+
+        lines = self.pending_lines
+        self.pending_lines = []
+
+        if not self.following:
+            self.notices.extend(line for line, notice in lines if notice)
+            return
 
-                for message in packet["array"]:
-                    self.messages.append(Message.from_packet(message))
+        at_bottom = self.chatbox.yview()[1] == 1
+        self.chatbox.insert(END, *(line for line, notice in lines))
+        self.rows.extend(not notice for line, notice in lines)
+        overflow = len(self.rows) - CHAT_VIEW_LINES
 
-                self.draw_messages()
-            elif packet["header"] == "user-leave":
-                user = User.from_packet(packet["user"])
-                
-                for _user in self.users:
-                    if _user.id == user.id:
-                        self.users.remove(_user)
-                        self.draw_users()
-                        break
-            elif packet["header"] == "user":
-                user = User.from_packet(packet)
+        if overflow > 0:
+            self.chatbox.delete(0, overflow - 1)
 
-                if (packet.get("is-me")):
-                    self.user = user
-                else:
-                    self.users.append(user)
+            for _ in range(overflow):
+                self.rows.popleft()
 
-                self.draw_user(user)
-            elif packet["header"] == "message":
-                message = Message.from_packet(packet)
-                self.messages.append(message)
-                self.draw_message(message)
-            elif packet["header"] == "announcement":
-                announcement = Announcement.from_packet(packet)
-                self.draw_announcement(announcement)
+            self.view_start = max(0, len(self.connection.messages) - sum(self.rows))
+
+        if at_bottom:
+            self.chatbox.see(END)
 
     '''
-    Sends the user for this client to the server
+    Event which fires when the server drops a message because it is being sent too quickly
     '''
-    def send_user(self):
-        packet = self.user.build_packet()
-        DataTransfer.send_packet(self, packet)
+    def rate_limited(self, retry_after: float):
+        self.draw_announcement(Announcement(f"You Are Sending Too Quickly, Wait {retry_after:.1f}s"))
+
+    '''
+    Event which fires once the server disconnects or stops sending anything
+    '''
+    def disconnected(self):
+        self.reconnecting = True
+        self.draw_notice(self.format_message(Message(SERVER_DISCONNECT_MESSAGE, SYSTEM_USER)))
+        self.flush_lines()
+        self.disable_widgets()
+
+    '''
+    Event which fires once the client has connected to the server
+    - After a reconnect the server gives this client's user a new ID, so the row for the old ID is removed
+    '''
+    def connected(self):
+        if not self.reconnecting:
+            return
+
+        self.reconnecting = False
+        self.enable_widgets()
+
+        if self.own_id in self.roster:
+            index = self.roster.index(self.own_id)
+            self.roster.pop(index)
+            self.userbox.delete(index)
+
+        self.draw_notice(self.format_message(Message(SERVER_RECONNECT_MESSAGE, SYSTEM_USER)))
 
     '''
     Sends a message to the server
     '''
     def send_message(self, message: Message):
         if self.typebox.get():
-            packet = message.build_packet()
-            DataTransfer.send_packet(self, packet)
+            self.connection.send_message(message.content)
+
+    '''
+    Sends a direct message typed as a user name followed by the message
+    - The users are copied before they are searched, the connection's thread can change them at any time
+    '''
+    def send_direct_message(self, content: str):
+        name, _, text = content.partition(" ")
+        recipient = next((user for user in list(self.connection.users.values()) if user.name == name), None)
+
+        if recipient is None:
+            self.draw_announcement(Announcement(f"No User Named {name}"))
+        elif text:
+            self.connection.send_direct_message([recipient.id], text)
+
+    '''
+    Asks for a file and uploads it, the message is sent with the file attached once the upload is stored
+    - The file is hashed and sent from a background thread so a large file does not freeze the user interface
+    '''
+    def attach_file(self, content: str):
+        path = askopenfilename()
+
+        if not path:
+            return
+
+        self.pending_attachments[path] = content
+        Thread(target = self.connection.upload_attachment, args = (path,), daemon = True).start()
+
+    '''
+    Event which fires when an upload has been stored, sends the message it was attached to
+    '''
+    def attachment_uploaded(self, digest: str, path: str):
+        if path not in self.pending_attachments:
+            return
+
+        attachment = {
+            "hash": digest,
+            "name": os.path.basename(path)[:63]
+        }
+
+        self.connection.send_message(self.pending_attachments.pop(path), attachment = attachment)
+
+    '''
+    Downloads the newest attachment with the given file name, asking where to save it
+    '''
+    def download_file(self, name: str):
+        message = next((message for message in reversed(self.connection.messages) if message.attachment and message.attachment["name"] == name), None)
+
+        if message is None:
+            self.draw_announcement(Announcement(f"No Attachment Named {name}"))
+            return
+
+        path = asksaveasfilename(initialfile = name)
+
+        if path:
+            self.connection.download_attachment(message.attachment["hash"], path)
 
     '''
     Draws a user to the user interface
+    - Users already in the user list are left alone, so only the rows which changed are touched
     '''
     def draw_user(self, user: User):
-        self.userbox.insert(END, f"[YOU] {user.name}" if self.user.id == user.id else user.name)
+        if user.id in self.roster:
+            return
+
+        self.roster.append(user.id)
+
+        if self.connection.user.id == user.id:
+            self.own_id = user.id
+            self.userbox.insert(END, f"[YOU] {user.name}")
+        else:
+            self.userbox.insert(END, user.name)
+
+    '''
+    Removes a single user from the user interface
+    '''
+    def erase_user(self, user: User):
+        if user.id in self.roster:
+            index = self.roster.index(user.id)
+            self.roster.pop(index)
+            self.userbox.delete(index)
 
     '''
     Draws a message to the user interface
     '''
     def draw_message(self, message: Message):
-        self.chatbox.insert(END, f"[{message.sender.name}]: {message.content}")
+        self.pending_lines.append((self.format_message(message), False))
+
+    '''
+    Draws a line which is not one of the room's messages to the user interface
+    '''
+    def draw_notice(self, line: str):
+        self.pending_lines.append((line, True))
+
+    '''
+    Returns the chatbox line for a message, naming the attached file if there is one
+    '''
+    def format_message(self, message: Message):
+        if message.attachment is None:
+            return f"[{message.sender.name}]: {message.content}"
+
+        return f"[{message.sender.name}]: {message.content} [{message.attachment['name']}]"
+
+    '''
+    Draws a direct message to the user interface
+    '''
+    def draw_direct_message(self, message: Message):
+        self.draw_notice(f"(Private) {self.format_message(message)}")
+
+    '''
+    Event which fires when the server accepts a direct message, tells the user about recipients which were offline
+    '''
+    def direct_message_acknowledged(self, undelivered: list):
+        for user_id in undelivered:
+            user = self.connection.users.get(user_id)
+            self.draw_announcement(Announcement(f"{user.name if user is not None else user_id} Is Not Online"))
 
     '''
     Draws an announcement to the user interface
     '''
     def draw_announcement(self, announcement: Announcement):
-        self.chatbox.insert(END, f"[{SERVER_USER.name}]: {announcement.content}")
+        self.draw_notice(f"[{SERVER_USER.name}]: {announcement.content}")
 
     '''
-    Draws all of the cached users to the user interface
+    Draws all of the cached users to the user interface, only used when the server replaces the whole user list
     '''
     def draw_users(self):
         self.userbox.delete(0, END)
-        self.draw_user(self.user)
+        self.roster = []
+        self.draw_user(self.connection.user)
 
-        for user in self.users:
+        for user in list(self.connection.users.values()):
             self.draw_user(user)
 
     '''
-    Draws all of the cached messages to the user interface
+    Draws a window of up to CHAT_VIEW_LINES cached messages to the user interface
+    - start: Index of the first message to draw, defaults to the window ending with the newest message
+    - Notices which have not been shown yet are kept, and drawn after the messages once the window reaches the newest
+    message
     '''
-    def draw_messages(self):
+    def draw_messages(self, start: int = None):
+        messages = list(self.connection.messages)
+
+        if start is None:
+            start = max(0, len(messages) - CHAT_VIEW_LINES)
+
+        self.view_start = start
+        self.following = start + CHAT_VIEW_LINES >= len(messages)
+        self.notices.extend(line for line, notice in self.pending_lines if notice)
+        self.pending_lines = []
+
+        lines = [self.format_message(message) for message in messages[start:start + CHAT_VIEW_LINES]]
+        self.rows = deque(True for line in lines)
         self.chatbox.delete(0, END)
+        self.chatbox.insert(END, *lines)
+
+        if self.following:
+            self.pending_lines = [(line, True) for line in self.notices]
+            self.notices.clear()
 
-        for message in self.messages:
-            self.draw_message(message)
+    '''
+    Draws the cached messages after the server replaced them or sent older ones
+    - Older messages asked for by scrolling up are shown from the top, anything else shows the newest messages
+    '''
+    def draw_history(self):
+        if self.showing_history:
+            self.showing_history = False
+            self.draw_messages(0)
+        else:
+            self.draw_messages()
+            self.chatbox.see(END)
+
+    '''
+    Moves the chatbox window up to older messages
+    - Older messages which are still cached are drawn straight away, once the window reaches the oldest cached
+    message the server is asked for the page before it
+    '''
+    def show_older_messages(self):
+        if self.view_start > 0:
+            self.draw_messages(max(0, self.view_start - CHAT_VIEW_LINES // 2))
+            self.chatbox.see(CHAT_VIEW_LINES // 2)
+        elif self.connection.more_history and not self.connection.history_pending:
+            self.showing_history = True
+            self.connection.request_history()
+
+    '''
+    Moves the chatbox window down to newer messages, going back to following new messages once it reaches the end
+    '''
+    def show_newer_messages(self):
+        if self.following:
+            return
+
+        self.draw_messages(self.view_start + CHAT_VIEW_LINES // 2)
+
+        if self.following:
+            self.chatbox.see(END)
 
     '''
     Event which fires when the Enter key is pressed in the typebox
+    - Text starting with the search command searches the room's messages instead of being sent
+    - Text starting with the direct message command is sent privately to the named user
+    - The attach command picks a file to send with the rest of the text, the download command saves an attachment
     '''
     def typebox_clicked_enter(self, key: Event):
-        message = Message(self.typebox_data.get(), self.user)
-        self.send_message(message)
+        content = self.typebox_data.get()
+
+        if content.startswith(SEARCH_COMMAND):
+            self.connection.search(content[len(SEARCH_COMMAND):])
+        elif content.startswith(DIRECT_MESSAGE_COMMAND):
+            self.send_direct_message(content[len(DIRECT_MESSAGE_COMMAND):])
+        elif content.startswith(ATTACH_COMMAND):
+            self.attach_file(content[len(ATTACH_COMMAND):].strip())
+        elif content.startswith(DOWNLOAD_COMMAND):
+            self.download_file(content[len(DOWNLOAD_COMMAND):])
+        else:
+            self.send_message(Message(content, self.connection.user))
+
         self.typebox_data.set("")
 
+    '''
+    Draws a page of search results to the user interface
+    '''
+    def draw_search_results(self, query: str, messages: list, more: bool):
+        self.draw_announcement(Announcement(f"{len(messages)}{'+' if more else ''} Messages Found For \"{query}\""))
+
+        for message in reversed(messages):
+            self.draw_notice(self.format_message(message))
+
+    '''
+    Event which fires when the chatbox is scrolled with the mouse wheel
+    - Loads older messages when scrolling up past the top of the chatbox, and newer ones when scrolling down past the
+    bottom of a window of older messages
+    '''
+    def chatbox_scrolled(self, event: Event):
+        scrolling_up = event.num == 4 or event.delta > 0
+
+        if scrolling_up and self.chatbox.yview()[0] == 0:
+            self.show_older_messages()
+        elif not scrolling_up and self.chatbox.yview()[1] == 1:
+            self.show_newer_messages()
+
     '''
     Disables all of the widgets in the user interface
     '''
@@ -163,6 +411,14 @@ class ChatRoomClient(socket.socket, Tk):
         self.userbox.configure(state = DISABLED)
         self.typebox.configure(state = DISABLED)
 
+    '''
+    Enables all of the widgets in the user interface again
+    '''
+    def enable_widgets(self):
+        self.chatbox.configure(state = NORMAL)
+        self.userbox.configure(state = NORMAL)
+        self.typebox.configure(state = NORMAL)
+
     '''
     Draws all of the widgets to the user interface
     '''
@@ -173,6 +429,9 @@ class ChatRoomClient(socket.socket, Tk):
         self.chatbox.configure(foreground = "#ffffff", background = "#404040")
         self.chatbox.configure(borderwidth = 0, highlightthickness = 0)
         self.chatbox.configure(font = ("Agency FB", 15))
+        self.chatbox.bind("<MouseWheel>", self.chatbox_scrolled)
+        self.chatbox.bind("<Button-4>", self.chatbox_scrolled)
+        self.chatbox.bind("<Button-5>", self.chatbox_scrolled)
         self.chatbox.place(x = 10, y = 10, height = 425, width = 600)
 
         self.userbox = Listbox(self)
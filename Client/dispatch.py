@@ -0,0 +1,51 @@
+
+'''
+Returns a function which calls a middleware with the rest of the chain after it
+'''
+def wrap(middleware, call_next):
+    return lambda *args: middleware(call_next, *args)
+
+'''
+PacketDispatcher Class
+- Maps packet headers to the functions which handle them, a new packet type is added by registering a handler for
+its header instead of adding another branch to a chain of ifs
+- Finding the handler is a single dictionary lookup however many packet types there are
+- The arguments passed to dispatch are passed on to the middleware and the handler, the packet is always the last
+- Middleware wraps every handler call, each one is called as middleware(call_next, *args) and either calls
+call_next(*args) to carry on or returns without calling it to drop the packet, the first added runs first
+- Packets without a registered handler are ignored before any middleware runs
+'''
+class PacketDispatcher:
+    def __init__(self):
+        self.handlers = {}
+        self.middleware = []
+        self.chain = self.call_handler
+
+    '''
+    Sets the handler for packets with the given header, replacing any handler it had before
+    '''
+    def register(self, header: str, handler):
+        self.handlers[header] = handler
+
+    '''
+    Adds a middleware after every middleware added so far
+    - The chain is built once here, dispatching a packet does not walk the list of middleware
+    '''
+    def use(self, middleware):
+        self.middleware.append(middleware)
+        self.chain = self.call_handler
+
+        for middleware in reversed(self.middleware):
+            self.chain = wrap(middleware, self.chain)
+
+    '''
+    Passes a packet through the middleware to the handler registered for its header
+    '''
+    def dispatch(self, *args):
+        header = args[-1].get("header")
+
+        if isinstance(header, str) and header in self.handlers:
+            self.chain(*args)
+
+    def call_handler(self, *args):
+        self.handlers[args[-1]["header"]](*args)
@@ -1,75 +1,65 @@
 
-from threading import Thread, Lock
-import socket
-import json
-import time
+from wire_format import *
+import struct
 
 '''
-Static class used for transferring data over a network
+Frame constants
+- FRAME_HEADER: Every frame starts with a 4 byte big endian unsigned integer holding the length of the payload
+- MAX_FRAME_SIZE: Frames larger than this are treated as a broken connection instead of being buffered
 '''
-class DataTransfer:
-    lock = Lock()
+FRAME_HEADER = struct.Struct(">I")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
 
-    '''
-    Sends a dictionary packet to a socket
-    - Serialises and encodes the packet and then sends it
-    '''
-    @classmethod
-    def send_packet(cls, sock: socket.socket, packet: dict):
-        serial = json.dumps(packet)
-        cls.send_data(sock, serial.encode())
+'''
+FrameBuffer class
+- Reassembles length prefixed frames from a stream of bytes
+- Handles frames which arrive split over several reads as well as several frames arriving in a single read
+'''
+class FrameBuffer:
+    def __init__(self):
+        self.buffer = bytearray()
 
     '''
-    Opens a thread to send raw data to a socket
+    Appends received bytes to the buffer
     '''
-    @classmethod
-    def send_data(cls, sock: socket.socket, data: bytes):
-        Thread(target = cls._send_data, args = (sock, data)).start()
+    def feed(self, data: bytes):
+        self.buffer += data
 
     '''
-    Receives a dictionary packet from a socket
-    - Decodes and deserialises data received
+    Removes and returns the next complete frame payload, or None if a full frame has not arrived yet
     '''
-    @classmethod
-    def recv_packet(cls, sock: socket.socket, bufferlen: int):
-        data = cls.recv_data(sock, bufferlen)
-        return json.loads(data.decode())
+    def next_frame(self):
+        if len(self.buffer) < FRAME_HEADER.size:
+            return None
 
-    '''
-    Receives a certain amount of bytes from a socket
-    '''
-    @classmethod
-    def recv_data(cls, sock: socket.socket, bufferlen: int):
-        return sock.recv(bufferlen)
+        (length,) = FRAME_HEADER.unpack_from(self.buffer)
 
-    '''
-    Sends data to a socket in a thread safe manner
-    - Ensures data sending is synced between all the threads calling it
-    - Allows the receiver to receive data one packet at a time to prevent overlapping packets
-    - Allows for a max of 10 packets per second to be sent to the server
-    '''
-    @classmethod
-    def _send_data(cls, sock: socket.socket, data: bytes):
-        cls.lock.acquire()
-        time.sleep(0.1)
-        sock.send(data)
-        cls.lock.release()
+        if length > MAX_FRAME_SIZE:
+            raise ConnectionError(f"Frame of {length} bytes exceeds the maximum frame size")
 
-    '''
-    Checks to see if a socket is connected or not
-    - Tries to send a dummy packet to the socket, if it failed it is not connected
-    '''
-    @classmethod
-    def socket_is_connected(cls, sock: socket.socket):
-        packet = {
-            "header": "connection-test"
-        }
+        end = FRAME_HEADER.size + length
+
+        if len(self.buffer) < end:
+            return None
+
+        frame = bytes(self.buffer[FRAME_HEADER.size:end])
+        del self.buffer[:end]
 
-        serial = json.dumps(packet)
+        return frame
 
-        try:
-            sock.send(serial.encode())
-            return True
-        except:
-            return False
+    '''
+    Prefixes a payload with its length so it can be sent as a single frame
+    '''
+    @staticmethod
+    def encode_frame(data: bytes):
+        return FRAME_HEADER.pack(len(data)) + data
 
+'''
+Compression constants
+- DEFLATE: The name of the only compression method, offered to the server in the user packet
+- COMPRESSED_MARKER: The first byte of a compressed payload, JSON and binary packets never start with it
+- SYNC_TRAILER: The server leaves these bytes off the end of every compressed payload, they are added back here
+'''
+DEFLATE = "deflate"
+COMPRESSED_MARKER = b"\xff"
+SYNC_TRAILER = b"\x00\x00\xff\xff"
@@ -0,0 +1,768 @@
+
+from chatroom_objects import *
+from networking import *
+from dispatch import PacketDispatcher
+from threading import Thread, Condition
+from collections import deque
+import asyncio
+import hashlib
+import logging
+import socket
+import random
+import json
+import time
+import zlib
+import os
+
+log = logging.getLogger(__name__)
+
+'''
+ChatSession Class
+- Everything a client needs to take part in a chat room apart from the connection itself: the wire format, the
+state of the room and the events fired as packets arrive
+- Subclasses provide the connection by implementing write, which must queue a frame without blocking
+- Event callbacks are attributes which start out as None and can be set to any function:
+    - on_connect(): The connection to the server is open and the user has been sent, fires again after every reconnect
+    - on_user_join(user, room): A user joined a room, this includes this client's own user once the server accepts it
+    - on_user_leave(user, room): A user left a room
+    - on_message(message, room): A message was sent in a room
+    - on_announcement(announcement, room): The server made an announcement in a room
+    - on_users(room): The list of users was replaced by the server
+    - on_messages(room): The list of messages was replaced, or older messages were added to the front of it
+    - on_rate_limited(retry_after): A packet was dropped because this client is sending too quickly
+    - on_search(query, messages, more, room): A page of search results arrived, newest first
+    - on_direct_message(message, conversation): A direct message was sent to or by this client, the conversation is a
+    tuple of the IDs of every participant
+    - on_direct_message_ack(ref, message_id, undelivered): The server accepted a direct message sent by this client,
+    undelivered lists the recipients which were not online
+    - on_direct_history(conversation, more): Older messages were added to the front of a conversation
+    - on_attachment_uploaded(digest, path): A file uploaded by this client is stored and can be attached to messages
+    - on_attachment_downloaded(digest, path): An attachment has been downloaded and saved to the given path
+    - on_attachment_failed(digest): The server does not have an attachment or its transfer was cut short, uploading
+    or downloading it again continues from where it stopped
+    - on_disconnect(): The connection to the server was lost, the client reconnects by itself unless it was closed
+- The users and messages are kept for every room the client is in together, clients which use several rooms can
+keep their own state from the room passed to the callbacks
+- At most message_limit messages are kept, for the rooms and for each conversation, so a long running client uses
+the same memory however many messages it has seen, older messages can be asked for again with request_history
+- After reconnecting the client resumes instead of starting over, the server only sends the users and messages which
+changed while it was away
+- Attachments are moved on a transfer connection of their own in a background thread, so the attachment events fire
+on that thread
+'''
+class ChatSession:
+    def __init__(self, username: str):
+        self.user = User(username)
+        self.users = {}
+        self.messages = []
+        self.message_limit = MESSAGE_CACHE_SIZE
+        self.more_history = False
+        self.history_pending = False
+        self.conversations = {}
+        self.next_ref = 0
+        self.uploads = {}
+        self.downloads = {}
+
+        self.framebuffer = FrameBuffer()
+        self.format = JSON
+        self.decompressor = None
+        self.stopped = False
+
+        self.on_connect = None
+        self.on_user_join = None
+        self.on_user_leave = None
+        self.on_message = None
+        self.on_announcement = None
+        self.on_users = None
+        self.on_messages = None
+        self.on_rate_limited = None
+        self.on_search = None
+        self.on_direct_message = None
+        self.on_direct_message_ack = None
+        self.on_direct_history = None
+        self.on_attachment_uploaded = None
+        self.on_attachment_downloaded = None
+        self.on_attachment_failed = None
+        self.on_disconnect = None
+
+        self.dispatcher = PacketDispatcher()
+        self.register_handlers()
+
+    '''
+    Queues an encoded frame to be sent to the server, implemented by each kind of connection
+    '''
+    def write(self, frame: bytes):
+        raise NotImplementedError
+
+    '''
+    Forgets everything about the previous connection, each connection negotiates its own wire format and compression
+    '''
+    def reset_connection(self):
+        self.framebuffer = FrameBuffer()
+        self.format = JSON
+        self.decompressor = None
+        self.history_pending = False
+
+    '''
+    How long to wait before the given attempt to reconnect
+    - Exponential backoff with full jitter, so clients which lost the same server spread their reconnects out
+    instead of all arriving at once
+    - The exponent is capped well past the point where the wait reaches its maximum, so a client which has been
+    retrying for hours never overflows a float
+    '''
+    def reconnect_delay(self, attempt: int):
+        return random.uniform(0, min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** min(attempt, 16)))
+
+    '''
+    Calls an event callback if it has been set
+    - An exception raised by the callback is logged and does not reach the connection, the next event still fires
+    '''
+    def fire(self, callback, *args):
+        if callback is None:
+            return
+
+        try:
+            callback(*args)
+        except Exception:
+            log.exception("Event callback %s raised", getattr(callback, "__name__", callback))
+
+    '''
+    Sends a dictionary packet to the server
+    - Encodes the packet in the wire format agreed with the server and then queues it
+    '''
+    def send_packet(self, packet: dict):
+        self.write(FrameBuffer.encode_frame(WireFormat.encode(packet, self.format)))
+
+    '''
+    Sends the user for this client to the server
+    - Also tells the server which wire formats and compression methods this client can decode
+    - A client which has been connected before asks to resume, telling the server which users it knows about and the
+    newest message it has
+    '''
+    def send_user(self):
+        packet = self.user.build_packet()
+        packet["formats"] = SUPPORTED_FORMATS
+        packet["compression"] = [DEFLATE]
+
+        if self.user.id != -1:
+            packet["resume"] = {
+                "users": list(self.users)
+            }
+
+            if self.messages:
+                packet["resume"]["last-message"] = self.messages[-1].id
+
+        self.send_packet(packet)
+
+    '''
+    Sends a message to the server, in the default room unless another room is given
+    - attachment: The hash and file name of an uploaded file to attach to the message
+    '''
+    def send_message(self, content: str, room: str = None, attachment: dict = None):
+        packet = Message(content, self.user).build_packet()
+
+        if room is not None:
+            packet["room"] = room
+
+        if attachment is not None:
+            packet["attachment"] = attachment
+
+        self.send_packet(packet)
+
+    '''
+    Asks the server for the page of messages sent before the oldest message this client has
+    - Does nothing if a page is already on its way or the server said there are no older messages
+    '''
+    def request_history(self):
+        if self.history_pending or not self.more_history or not self.messages:
+            return
+
+        self.history_pending = True
+
+        packet = {
+            "header": "history",
+            "before": self.messages[0].id
+        }
+
+        self.send_packet(packet)
+
+    '''
+    Asks the server for the messages which match a search query
+    - Pass the ID of the oldest result received as before to get the next page
+    '''
+    def search(self, query: str, room: str = None, before: int = None):
+        packet = {
+            "header": "search",
+            "query": query
+        }
+
+        if room is not None:
+            packet["room"] = room
+
+        if before is not None:
+            packet["before"] = before
+
+        self.send_packet(packet)
+
+    '''
+    Sends a private message to one or more users, by the IDs of their users
+    - Returns the reference the server's acknowledgement will carry
+    '''
+    def send_direct_message(self, recipients: list, content: str):
+        self.next_ref += 1
+
+        packet = {
+            "header": "direct-message",
+            "recipients": list(recipients),
+            "content": content,
+            "ref": self.next_ref
+        }
+
+        self.send_packet(packet)
+        return self.next_ref
+
+    '''
+    Asks the server for the page of a conversation's messages sent before the oldest one this client has
+    '''
+    def request_direct_history(self, conversation: tuple):
+        messages = self.conversations.get(conversation)
+
+        packet = {
+            "header": "direct-history",
+            "conversation": list(conversation)
+        }
+
+        if messages:
+            packet["before"] = messages[0].id
+
+        self.send_packet(packet)
+
+    '''
+    Uploads a file so it can be attached to messages, returns the hash the attachment is referred to by
+    - The file is hashed first, a file the server already has is not sent again
+    '''
+    def upload_attachment(self, path: str):
+        digest = self.hash_file(path)
+        self.uploads[digest] = path
+
+        packet = {
+            "header": "attachment-upload",
+            "hash": digest,
+            "size": os.path.getsize(path)
+        }
+
+        self.send_packet(packet)
+        return digest
+
+    '''
+    Downloads an attachment to the given path, continuing an earlier download to the same path if there was one
+    '''
+    def download_attachment(self, digest: str, path: str):
+        partial = path + PARTIAL_SUFFIX
+        self.downloads[digest] = path
+
+        packet = {
+            "header": "attachment-download",
+            "hash": digest,
+            "offset": os.path.getsize(partial) if os.path.exists(partial) else 0
+        }
+
+        self.send_packet(packet)
+
+    '''
+    Runs a transfer granted by the server on a connection of its own, so the chat connection is never held up
+    - Uploads are sent straight from the file with sendfile, the server reports when the upload has been stored
+    - Downloads are written to a partial file which is checked against the hash and renamed once complete
+    '''
+    def transfer(self, packet: dict):
+        digest = packet["hash"]
+        path = (self.uploads if packet["kind"] == "upload" else self.downloads).get(digest)
+
+        if path is None:
+            return
+
+        request = {
+            "token": packet["token"],
+            "offset": packet["offset"]
+        }
+
+        try:
+            with socket.create_connection((self.ip, packet["port"]), SERVER_TIMEOUT) as sock:
+                sock.sendall(FrameBuffer.encode_frame(json.dumps(request).encode()))
+
+                if packet["kind"] == "upload":
+                    with open(path, "rb") as file:
+                        sock.sendfile(file, packet["offset"])
+
+                    sock.shutdown(socket.SHUT_WR)
+                    sock.recv(1)
+                    return
+
+                self.receive_download(sock, path, packet["offset"], packet["size"])
+        except OSError:
+            self.fire(self.on_attachment_failed, digest)
+            return
+
+        self.downloads.pop(digest, None)
+
+        if self.hash_file(path) != digest:
+            os.remove(path)
+            self.fire(self.on_attachment_failed, digest)
+        else:
+            self.fire(self.on_attachment_downloaded, digest, path)
+
+    '''
+    Receives the rest of a download into its partial file and moves it to its path once complete
+    '''
+    def receive_download(self, sock: socket.socket, path: str, offset: int, size: int):
+        partial = path + PARTIAL_SUFFIX
+
+        with open(partial, "ab") as file:
+            file.truncate(offset)
+            remaining = size - offset
+
+            while remaining:
+                data = sock.recv(min(TRANSFER_CHUNK_SIZE, remaining))
+
+                if not data:
+                    raise ConnectionError("Transfer closed by server")
+
+                file.write(data)
+                remaining -= len(data)
+
+        os.replace(partial, path)
+
+    '''
+    Returns the hex SHA-256 of a file
+    '''
+    def hash_file(self, path: str):
+        hasher = hashlib.sha256()
+
+        with open(path, "rb") as file:
+            while chunk := file.read(TRANSFER_CHUNK_SIZE):
+                hasher.update(chunk)
+
+        return hasher.hexdigest()
+
+    def join_room(self, room: str):
+        packet = {
+            "header": "room-join",
+            "room": room
+        }
+
+        self.send_packet(packet)
+
+    def leave_room(self, room: str):
+        packet = {
+            "header": "room-leave",
+            "room": room
+        }
+
+        self.send_packet(packet)
+
+    '''
+    Handles bytes received from the server, every complete packet in them is processed in order
+    '''
+    def receive_data(self, data: bytes):
+        self.framebuffer.feed(data)
+
+        while True:
+            frame = self.framebuffer.next_frame()
+
+            if frame is None:
+                break
+
+            self.handle_packet(self.decode_frame(frame))
+
+    '''
+    Decodes a single frame received from the server
+    - Decompresses the frame first if it was compressed, every compressed frame continues the same deflate stream
+    - The server only sends binary packets once it has accepted the binary format offered in the user packet, so the
+    first binary packet received switches the packets sent to the server over to the binary format as well
+    '''
+    def decode_frame(self, data: bytes):
+        if data[:1] == COMPRESSED_MARKER:
+            if self.decompressor is None:
+                self.decompressor = zlib.decompressobj(wbits = -zlib.MAX_WBITS)
+
+            data = self.decompressor.decompress(data[1:] + SYNC_TRAILER)
+
+        if WireFormat.is_binary(data):
+            self.format = BINARY
+
+        return WireFormat.decode(data)
+
+    '''
+    Processes a single packet received from the server
+    - Updates the state of the room and fires the matching event, packets nobody handles are ignored
+    '''
+    def handle_packet(self, packet: dict):
+        self.dispatcher.dispatch(packet)
+
+    '''
+    Registers the handler for every packet type the server can send
+    - Handlers are called with the packet, more can be registered on the dispatcher to handle packets the session
+    does not know about
+    '''
+    def register_handlers(self):
+        self.dispatcher.register("ping", self.send_pong)
+        self.dispatcher.register("users", self.receive_users)
+        self.dispatcher.register("users-diff", self.receive_users_diff)
+        self.dispatcher.register("messages", self.receive_messages)
+        self.dispatcher.register("history", self.receive_history)
+        self.dispatcher.register("user-leave", self.receive_user_leave)
+        self.dispatcher.register("user", self.receive_user)
+        self.dispatcher.register("message", self.receive_message)
+        self.dispatcher.register("announcement", self.receive_announcement)
+        self.dispatcher.register("rate-limited", self.receive_rate_limited)
+        self.dispatcher.register("search", self.receive_search)
+        self.dispatcher.register("direct-message", self.receive_direct_message)
+        self.dispatcher.register("direct-message-ack", self.receive_direct_message_ack)
+        self.dispatcher.register("direct-history", self.receive_direct_history)
+        self.dispatcher.register("attachment-transfer", self.start_transfer)
+        self.dispatcher.register("attachment-uploaded", self.receive_attachment_uploaded)
+        self.dispatcher.register("attachment-missing", self.receive_attachment_missing)
+
+    def send_pong(self, packet: dict):
+        packet = {
+            "header": "pong"
+        }
+
+        self.send_packet(packet)
+
+    def receive_users(self, packet: dict):
+        self.users = {}
+
+        for user in packet["array"]:
+            if user["id"] != self.user.id:
+                self.users[user["id"]] = User.from_packet(user)
+
+        self.fire(self.on_users, packet.get("room"))
+
+    def receive_users_diff(self, packet: dict):
+        room = packet.get("room")
+
+        for user_id in packet["removed"]:
+            user = self.users.pop(user_id, None)
+
+            if user is not None:
+                self.fire(self.on_user_leave, user, room)
+
+        for user in packet["added"]:
+            user = User.from_packet(user)
+
+            if user.id != self.user.id and user.id not in self.users:
+                self.users[user.id] = user
+                self.fire(self.on_user_join, user, room)
+
+    def receive_messages(self, packet: dict):
+        self.messages = [Message.from_packet(message) for message in packet["array"]]
+        self.more_history = packet.get("more", False)
+        self.fire(self.on_messages, packet.get("room"))
+
+    def receive_history(self, packet: dict):
+        messages = [Message.from_packet(message) for message in packet["array"]]
+        self.history_pending = False
+
+        if "before" in packet:
+            self.messages = messages + self.messages
+            self.more_history = packet.get("more", False)
+        else:
+            self.messages += messages
+            self.trim_messages()
+
+        self.fire(self.on_messages, packet.get("room"))
+
+    def receive_user_leave(self, packet: dict):
+        user = User.from_packet(packet["user"])
+
+        if self.users.pop(user.id, None) is not None:
+            self.fire(self.on_user_leave, user, packet.get("room"))
+
+    def receive_user(self, packet: dict):
+        user = User.from_packet(packet)
+
+        if packet.get("is-me"):
+            self.user = user
+        else:
+            self.users[user.id] = user
+
+        self.fire(self.on_user_join, user, packet.get("room"))
+
+    def receive_message(self, packet: dict):
+        message = Message.from_packet(packet)
+        self.messages.append(message)
+        self.trim_messages()
+        self.fire(self.on_message, message, packet.get("room"))
+
+    '''
+    Drops the oldest messages once more than message_limit are kept, the server still has them so there is more
+    history to ask for
+    '''
+    def trim_messages(self):
+        overflow = len(self.messages) - self.message_limit
+
+        if overflow > 0:
+            del self.messages[:overflow]
+            self.more_history = True
+
+    def receive_announcement(self, packet: dict):
+        self.fire(self.on_announcement, Announcement.from_packet(packet), packet.get("room"))
+
+    def receive_rate_limited(self, packet: dict):
+        self.fire(self.on_rate_limited, packet["retry-after"])
+
+    def receive_search(self, packet: dict):
+        messages = [Message.from_packet(message) for message in packet["array"]]
+        self.fire(self.on_search, packet["query"], messages, packet.get("more", False), packet.get("room"))
+
+    def receive_direct_message(self, packet: dict):
+        message = Message.from_packet(packet)
+        conversation = tuple(packet["conversation"])
+        messages = self.conversations.setdefault(conversation, [])
+        messages.append(message)
+
+        if len(messages) > self.message_limit:
+            del messages[:len(messages) - self.message_limit]
+
+        self.fire(self.on_direct_message, message, conversation)
+
+    def receive_direct_message_ack(self, packet: dict):
+        self.fire(self.on_direct_message_ack, packet["ref"], packet["id"], packet["undelivered"])
+
+    def receive_direct_history(self, packet: dict):
+        conversation = tuple(packet["conversation"])
+        messages = [Message.from_packet(message) for message in packet["array"]]
+        self.conversations[conversation] = messages + self.conversations.get(conversation, []) if "before" in packet else messages
+        self.fire(self.on_direct_history, conversation, packet.get("more", False))
+
+    '''
+    Runs a transfer the server granted in a background thread, so a large attachment never holds up the packets
+    behind it
+    '''
+    def start_transfer(self, packet: dict):
+        Thread(target = self.transfer, args = (packet,), daemon = True).start()
+
+    def receive_attachment_uploaded(self, packet: dict):
+        path = self.uploads.pop(packet["hash"], None)
+        self.fire(self.on_attachment_uploaded, packet["hash"], path)
+
+    def receive_attachment_missing(self, packet: dict):
+        self.downloads.pop(packet["hash"], None)
+        self.fire(self.on_attachment_failed, packet["hash"])
+
+'''
+ChatClient Class, a ChatSession connected with a blocking socket
+- One thread reads from the socket and fires the events, another drains the send queue
+- Sending never blocks the caller, packets are queued and written by the sender thread
+- The reader thread also reconnects once the connection is lost, packets sent while disconnected are dropped
+'''
+class ChatClient(ChatSession):
+    def __init__(self, ip: str, port: int, username: str):
+        super().__init__(username)
+        self.ip = ip
+        self.port = port
+        self.sock = None
+        self.outbound = deque()
+        self.outbound_condition = Condition()
+        self.closed = False
+
+    '''
+    Connects to the server and starts the reader thread
+    - Raises OSError if the server cannot be reached
+    '''
+    def connect(self):
+        self.open()
+        Thread(target = self.reader_loop, daemon = True).start()
+
+    '''
+    Opens a new connection to the server, starts its sender thread and sends the user
+    '''
+    def open(self):
+        sock = socket.create_connection((self.ip, self.port))
+        sock.settimeout(SERVER_TIMEOUT)
+
+        with self.outbound_condition:
+            self.sock = sock
+            self.outbound.clear()
+            self.closed = False
+
+        self.reset_connection()
+        Thread(target = self.sender_loop, args = (sock,), daemon = True).start()
+        self.send_user()
+        self.fire(self.on_connect)
+
+    '''
+    Keeps trying to open a new connection, waiting longer after every failed attempt
+    - Returns False if the client was closed before it managed to reconnect
+    '''
+    def reconnect(self):
+        attempt = 0
+
+        while not self.stopped:
+            time.sleep(self.reconnect_delay(attempt))
+
+            try:
+                self.open()
+                return True
+            except OSError:
+                attempt += 1
+
+        return False
+
+    def write(self, frame: bytes):
+        with self.outbound_condition:
+            if self.closed:
+                return
+
+            self.outbound.append(frame)
+            self.outbound_condition.notify()
+
+    '''
+    Receives data from the server, reconnecting whenever the connection is lost, until the client is closed
+    - The server pings idle clients, so a healthy connection is never quiet for longer than the server timeout
+    - Data which cannot be decoded or handled is treated like a lost connection, the client reconnects and resumes
+    '''
+    def reader_loop(self):
+        while True:
+            try:
+                data = self.sock.recv(65536)
+
+                if not data:
+                    raise ConnectionError("Connection closed by server")
+
+                self.receive_data(data)
+                continue
+            except OSError:
+                pass
+            except Exception:
+                log.exception("Could not handle data from the server, reconnecting")
+
+            self.disconnect()
+            self.fire(self.on_disconnect)
+
+            if not self.reconnect():
+                return
+
+    '''
+    Sends queued frames to the server one at a time, the only place where data is written to the socket
+    - Each connection has its own sender thread, which stops once its connection is closed
+    '''
+    def sender_loop(self, sock: socket.socket):
+        while True:
+            with self.outbound_condition:
+                while not self.outbound and not self.closed and self.sock is sock:
+                    self.outbound_condition.wait()
+
+                if self.closed or self.sock is not sock:
+                    return
+
+                frame = self.outbound.popleft()
+
+            try:
+                sock.sendall(frame)
+            except OSError:
+                self.disconnect()
+                return
+
+    '''
+    Closes the current connection, the reader thread notices and reconnects
+    '''
+    def disconnect(self):
+        with self.outbound_condition:
+            self.closed = True
+            self.outbound.clear()
+            self.outbound_condition.notify_all()
+
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+        self.sock.close()
+
+    '''
+    Closes the connection for good, the client does not reconnect
+    '''
+    def close(self):
+        self.stopped = True
+        self.disconnect()
+
+'''
+AsyncChatClient Class, a ChatSession connected with asyncio streams
+- Needs no threads, so hundreds of clients can share a single event loop
+- Sending never blocks, frames are handed to the stream's transport which buffers them until they can be written
+- run reconnects once the connection is lost, packets sent while disconnected are dropped
+'''
+class AsyncChatClient(ChatSession):
+    def __init__(self, ip: str, port: int, username: str):
+        super().__init__(username)
+        self.ip = ip
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    '''
+    Connects to the server and sends the user
+    - Raises OSError if the server cannot be reached
+    '''
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.ip, self.port)
+        self.reset_connection()
+        self.send_user()
+        self.fire(self.on_connect)
+
+    '''
+    Keeps trying to connect again, waiting longer after every failed attempt
+    - Returns False if the client was closed before it managed to reconnect
+    '''
+    async def reconnect(self):
+        attempt = 0
+
+        while not self.stopped:
+            await asyncio.sleep(self.reconnect_delay(attempt))
+
+            try:
+                await self.connect()
+                return True
+            except OSError:
+                attempt += 1
+
+        return False
+
+    def write(self, frame: bytes):
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.write(frame)
+
+    '''
+    Receives data from the server and fires the events, reconnecting whenever the connection is lost, until the
+    client is closed
+    - Data which cannot be decoded or handled is treated like a lost connection, the client reconnects and resumes
+    '''
+    async def run(self):
+        while True:
+            try:
+                data = await asyncio.wait_for(self.reader.read(65536), SERVER_TIMEOUT)
+
+                if data:
+                    self.receive_data(data)
+                    continue
+            except (OSError, asyncio.TimeoutError):
+                pass
+            except Exception:
+                log.exception("Could not handle data from the server, reconnecting")
+
+            self.writer.close()
+            self.fire(self.on_disconnect)
+
+            if not await self.reconnect():
+                return
+
+    '''
+    Closes the connection for good, run returns once the connection has closed
+    '''
+    def close(self):
+        self.stopped = True
+
+        if self.writer is not None:
+            self.writer.close()
@@ -0,0 +1,252 @@
+
+import struct
+import json
+
+'''
+Wire format constants
+- JSON: Packets are sent as JSON text, every client and server understands this format
+- BINARY: The most common packets are sent as compact struct packed records, anything else is still sent as JSON
+- SUPPORTED_FORMATS: The formats this side of the connection can decode, sent to the server in the user packet
+'''
+JSON = "json"
+BINARY = "binary"
+SUPPORTED_FORMATS = [BINARY, JSON]
+
+'''
+Binary opcodes
+- The first byte of a binary packet is its opcode, a JSON packet always starts with "{" so the two formats can be
+told apart by looking at the first byte of a frame
+'''
+OP_USER = 1
+OP_MESSAGE = 2
+OP_ANNOUNCEMENT = 3
+OP_USER_LEAVE = 4
+OP_MESSAGES = 5
+OP_HISTORY = 6
+
+OPCODES = {
+    "user": OP_USER,
+    "message": OP_MESSAGE,
+    "announcement": OP_ANNOUNCEMENT,
+    "user-leave": OP_USER_LEAVE,
+    "messages": OP_MESSAGES,
+    "history": OP_HISTORY
+}
+
+'''
+Binary field layouts
+- IDs are fixed 8 byte signed integers, the time ordered IDs handed out by the server use around 60 bits so a
+variable length encoding would not make them any smaller
+- Strings are a 2 byte length followed by UTF-8
+- Optional strings, such as the room, are sent as an empty string when they are missing
+'''
+OPCODE = struct.Struct(">B")
+FLAGS = struct.Struct(">B")
+ID = struct.Struct(">q")
+LENGTH = struct.Struct(">H")
+MESSAGE_PREFIX = struct.Struct(">qqH")
+
+FLAG_IS_ME = 1
+FLAG_MORE = 1
+FLAG_BEFORE = 2
+FLAG_AFTER = 4
+
+'''
+Static class used for encoding and decoding packets in either wire format
+'''
+class WireFormat:
+    '''
+    Encodes a dictionary packet in the given format
+    - Packets which have no binary layout, or which do not fit it, are encoded as JSON even when the binary format
+    was asked for
+    '''
+    @classmethod
+    def encode(cls, packet: dict, format: str = JSON):
+        if format == BINARY and packet.get("header") in OPCODES:
+            try:
+                return cls.encode_binary(packet)
+            except (struct.error, KeyError, TypeError, AttributeError, ValueError):
+                pass
+
+        return json.dumps(packet).encode()
+
+    '''
+    Decodes a packet in either format back into a dictionary
+    '''
+    @classmethod
+    def decode(cls, data: bytes):
+        if data[:1] == b"{":
+            return json.loads(data.decode())
+
+        return cls.decode_binary(data)
+
+    '''
+    Checks whether encoded packet data is in the binary format
+    '''
+    @classmethod
+    def is_binary(cls, data: bytes):
+        return data[:1] != b"{"
+
+    @classmethod
+    def encode_binary(cls, packet: dict):
+        header = packet["header"]
+        parts = [OPCODE.pack(OPCODES[header])]
+
+        if header == "user":
+            parts.append(FLAGS.pack(FLAG_IS_ME if packet.get("is-me") else 0))
+            cls.pack_user(parts, packet)
+            cls.pack_string(parts, packet.get("room", ""))
+        elif header == "message":
+            cls.pack_message(parts, packet)
+            cls.pack_string(parts, packet.get("room", ""))
+        elif header == "announcement":
+            cls.pack_string(parts, packet["content"])
+            cls.pack_string(parts, packet.get("room", ""))
+        elif header == "user-leave":
+            cls.pack_user(parts, packet["user"])
+            cls.pack_string(parts, packet.get("room", ""))
+        else:
+            flags = FLAG_MORE if packet.get("more") else 0
+            flags |= FLAG_BEFORE if "before" in packet else 0
+            flags |= FLAG_AFTER if "after" in packet else 0
+
+            parts.append(FLAGS.pack(flags))
+
+            if "before" in packet:
+                parts.append(ID.pack(packet["before"]))
+
+            if "after" in packet:
+                parts.append(ID.pack(packet["after"]))
+
+            cls.pack_string(parts, packet.get("room", ""))
+            parts.append(LENGTH.pack(len(packet["array"])))
+
+            for message in packet["array"]:
+                cls.pack_message(parts, message)
+
+        return b"".join(parts)
+
+    @classmethod
+    def decode_binary(cls, data: bytes):
+        (opcode,) = OPCODE.unpack_from(data)
+        offset = OPCODE.size
+
+        if opcode == OP_USER:
+            (flags,) = FLAGS.unpack_from(data, offset)
+            packet, offset = cls.unpack_user(data, offset + FLAGS.size)
+            packet["header"] = "user"
+
+            if flags & FLAG_IS_ME:
+                packet["is-me"] = True
+        elif opcode == OP_MESSAGE:
+            packet, offset = cls.unpack_message(data, offset)
+        elif opcode == OP_ANNOUNCEMENT:
+            content, offset = cls.unpack_string(data, offset)
+            packet = {
+                "header": "announcement",
+                "content": content
+            }
+        elif opcode == OP_USER_LEAVE:
+            user, offset = cls.unpack_user(data, offset)
+            packet = {
+                "header": "user-leave",
+                "user": user
+            }
+        elif opcode in (OP_MESSAGES, OP_HISTORY):
+            (flags,) = FLAGS.unpack_from(data, offset)
+            offset += FLAGS.size
+
+            packet = {
+                "header": "messages" if opcode == OP_MESSAGES else "history",
+                "more": bool(flags & FLAG_MORE)
+            }
+
+            if flags & FLAG_BEFORE:
+                (packet["before"],) = ID.unpack_from(data, offset)
+                offset += ID.size
+
+            if flags & FLAG_AFTER:
+                (packet["after"],) = ID.unpack_from(data, offset)
+                offset += ID.size
+
+            room, offset = cls.unpack_string(data, offset)
+            (count,) = LENGTH.unpack_from(data, offset)
+            offset += LENGTH.size
+
+            packet["array"] = []
+
+            for _ in range(count):
+                message, offset = cls.unpack_message(data, offset)
+                packet["array"].append(message)
+
+            if room:
+                packet["room"] = room
+
+            return packet
+        else:
+            raise ValueError(f"Unknown binary opcode {opcode}")
+
+        room, offset = cls.unpack_string(data, offset)
+
+        if room:
+            packet["room"] = room
+
+        return packet
+
+    @classmethod
+    def pack_string(cls, parts: list, string: str):
+        data = string.encode()
+        parts.append(LENGTH.pack(len(data)))
+        parts.append(data)
+
+    @classmethod
+    def unpack_string(cls, data: bytes, offset: int):
+        (length,) = LENGTH.unpack_from(data, offset)
+        offset += LENGTH.size
+
+        return data[offset:offset + length].decode(), offset + length
+
+    @classmethod
+    def pack_user(cls, parts: list, user: dict):
+        parts.append(ID.pack(user["id"]))
+        cls.pack_string(parts, user["name"])
+
+    @classmethod
+    def unpack_user(cls, data: bytes, offset: int):
+        (id,) = ID.unpack_from(data, offset)
+        name, offset = cls.unpack_string(data, offset + ID.size)
+
+        return {
+            "id": id,
+            "name": name
+        }, offset
+
+    '''
+    Packs a message, messages with an attachment have no binary layout so the packet holding them is sent as JSON
+    '''
+    @classmethod
+    def pack_message(cls, parts: list, message: dict):
+        if "attachment" in message:
+            raise TypeError("Messages with attachments have no binary layout")
+
+        name = message["sender"]["name"].encode()
+        parts.append(MESSAGE_PREFIX.pack(message["id"], message["sender"]["id"], len(name)))
+        parts.append(name)
+        cls.pack_string(parts, message["content"])
+
+    @classmethod
+    def unpack_message(cls, data: bytes, offset: int):
+        id, sender_id, length = MESSAGE_PREFIX.unpack_from(data, offset)
+        offset += MESSAGE_PREFIX.size
+        name = data[offset:offset + length].decode()
+        content, offset = cls.unpack_string(data, offset + length)
+
+        return {
+            "header": "message",
+            "id": id,
+            "content": content,
+            "sender": {
+                "id": sender_id,
+                "name": name
+            }
+        }, offset
@@ -0,0 +1,289 @@
+
+from chatroom_objects import *
+from networking import FrameBuffer, FRAME_HEADER, MAX_FRAME_SIZE
+from history import MessageHistory
+from registry import ClientRegistry
+from heartbeat import HeartbeatMonitor
+import asyncio
+import logging
+import socket
+import json
+import time
+
+log = logging.getLogger(__name__)
+
+'''
+AsyncClient class
+- Stores useful information about a client connected to the asyncio server, such as the ip and streams
+'''
+class AsyncClient:
+    def __init__(self, ip: str, port: int, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.ip = ip
+        self.port = port
+        self.reader = reader
+        self.writer = writer
+        self.received_user = False
+        self.user = None
+        self.last_seen = time.monotonic()
+        self.pinged = False
+
+    '''
+    Whether the connection to the client has been closed, checked by the heartbeat monitor
+    '''
+    @property
+    def closed(self):
+        return self.writer.is_closing()
+
+    '''
+    Sends a dictionary packet to the client
+    - The frame is written to the transport's buffer straight away, there is no thread or lock involved
+    '''
+    def send_packet(self, packet: dict):
+        self.send_data(json.dumps(packet).encode())
+
+    '''
+    Sends raw data to the client as a single frame
+    '''
+    def send_data(self, data: bytes):
+        self.send_frame(FrameBuffer.encode_frame(data))
+
+    '''
+    Sends an already encoded frame to the client
+    '''
+    def send_frame(self, frame: bytes):
+        if not self.writer.is_closing():
+            self.writer.write(frame)
+
+    '''
+    Receives a dictionary packet from the client
+    - Raises asyncio.IncompleteReadError once the client disconnects
+    '''
+    async def recv_packet(self):
+        header = await self.reader.readexactly(FRAME_HEADER.size)
+        (length,) = FRAME_HEADER.unpack(header)
+
+        if length > MAX_FRAME_SIZE:
+            raise ConnectionError(f"Frame of {length} bytes exceeds the maximum frame size")
+
+        data = await self.reader.readexactly(length)
+        return json.loads(data.decode())
+
+'''
+AsyncChatRoomServer Class, event loop based alternative to ChatRoomServer
+- Every client is a coroutine on a single thread instead of an OS thread
+- Uses the same packet classes, headers and framing as ChatRoomServer so existing clients work unchanged
+'''
+class AsyncChatRoomServer:
+    def __init__(self, ip: str, port: int, history_capacity: int = 1000):
+        self.ip = ip
+        self.port = port
+        self.clients = ClientRegistry()
+        self.messages = MessageHistory(history_capacity)
+        self.history_page_size = 50
+        self.heartbeat_interval = 15
+        self.heartbeat_timeout = 45
+        self.heartbeat = None
+        self.heartbeat_task = None
+        self.server = None
+
+        self.validate_user = lambda user: len(user.name) < 16
+        self.validate_message = lambda message: isinstance(message.content, str) and len(message.content) < 128
+
+    '''
+    Starts the server and serves clients until cancelled
+    - Runs the heartbeat monitor as a task on the same event loop, pinging idle clients and disconnecting dead ones
+    '''
+    async def start(self):
+        self.heartbeat = HeartbeatMonitor(self.heartbeat_interval, self.heartbeat_timeout, self.ping_client, self.disconnect_client)
+        self.heartbeat_task = asyncio.create_task(self.heartbeat.run_async())
+        self.server = await asyncio.start_server(self.socket_listener, self.ip, self.port, backlog = 1024)
+
+        async with self.server:
+            await self.server.serve_forever()
+
+    '''
+    Receives data from a single client
+    - Coroutine which receives packets from a client and processes them
+    - Returns once the client disconnects
+    - A packet which cannot be handled is logged and dropped, the client's other packets are still handled
+    '''
+    async def socket_listener(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        addr = writer.get_extra_info("peername")
+        client = AsyncClient(addr[0], addr[1], reader, writer)
+        self.clients.add(client)
+        self.heartbeat.add(client)
+
+        try:
+            while True:
+                try:
+                    packet = await client.recv_packet()
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except ValueError:
+                    continue
+
+                self.heartbeat.touch(client)
+
+                try:
+                    self.handle_packet(client, packet)
+                except Exception:
+                    log.exception("Dropped a packet from %s:%s whose handler raised", client.ip, client.port)
+        finally:
+            self.disconnect_client(client)
+
+    '''
+    Processes a single packet received from a client
+    '''
+    def handle_packet(self, client: AsyncClient, packet: dict):
+        if packet["header"] == "ping":
+            client.send_packet({
+                "header": "pong"
+            })
+        elif packet["header"] == "pong":
+            return
+        elif packet["header"] == "user" and client.user is None:
+            user = User.from_packet(packet)
+            client.received_user = True
+
+            if self.validate_user(user):
+                user.id = ObjectIDGenerator.generate_id()
+                User.register(user)
+                client.user = user
+                self.broadcast_user(user)
+                self.broadcast_announcement(Announcement(f"{user.name} Has Joined"))
+
+                if len(self.clients) > 1:
+                    self.send_users(client)
+
+                self.clients.add_user(client, user)
+
+                if len(self.messages):
+                    self.send_messages(client)
+        elif packet["header"] == "message" and client.user is not None:
+            message = Message(packet["content"], client.user)
+
+            if self.validate_message(message):
+                message.id = ObjectIDGenerator.generate_id()
+                self.messages.append(message)
+                self.broadcast_message(message)
+        elif packet["header"] == "history":
+            self.send_history(client, packet)
+
+    '''
+    Removes a client which has disconnected
+    - Only tells the other clients about the leave if the client had sent its user
+    - Safe to call more than once, the leave is only broadcast the first time
+    '''
+    def disconnect_client(self, client: AsyncClient):
+        if not self.clients.remove(client):
+            return
+
+        client.writer.close()
+
+        if client.received_user and client.user is not None:
+            self.broadcast_leave(client.user)
+            self.broadcast_announcement(Announcement(f"{client.user.name} Has Left"))
+
+    '''
+    Sends a ping to a client which has been quiet for the heartbeat interval, the client answers with a pong
+    '''
+    def ping_client(self, client: AsyncClient):
+        client.send_packet({
+            "header": "ping"
+        })
+
+    '''
+    Tells all clients that a new user has connected
+    - packet["is-me"] becomes true if the client being sent the packet is the new user
+    '''
+    def broadcast_user(self, user: User):
+        packet = user.build_packet()
+        frame = FrameBuffer.encode_frame(json.dumps(packet).encode())
+
+        packet["is-me"] = True
+        me_frame = FrameBuffer.encode_frame(json.dumps(packet).encode())
+
+        for client in self.clients:
+            client.send_frame(me_frame if client.user is user else frame)
+
+    '''
+    Tells all clients that a new message has been sent
+    '''
+    def broadcast_message(self, message: Message):
+        self.broadcast_packet(message.build_packet())
+
+    '''
+    Tells all clients that a client has disconnected
+    '''
+    def broadcast_leave(self, user: User):
+        self.broadcast_packet({
+            "header": "user-leave",
+            "user": user.build_json()
+        })
+
+    '''
+    Announces information to each client
+    '''
+    def broadcast_announcement(self, announcement: Announcement):
+        self.broadcast_packet(announcement.build_packet())
+
+    '''
+    Sends a packet to every connected client
+    - The packet is only serialised and framed once
+    '''
+    def broadcast_packet(self, packet: dict):
+        frame = FrameBuffer.encode_frame(json.dumps(packet).encode())
+
+        for client in self.clients:
+            client.send_frame(frame)
+
+    '''
+    Sends every connected user to a client
+    - Sent before the client's own user is added to the roster, so the client is not told about itself
+    '''
+    def send_users(self, client: AsyncClient):
+        client.send_data(self.clients.roster_data())
+
+    '''
+    Sends the most recent page of messages to a client
+    '''
+    def send_messages(self, client: AsyncClient):
+        messages = self.messages.last(self.history_page_size)
+
+        client.send_packet({
+            "header": "messages",
+            "array": [message.build_packet() for message in messages],
+            "more": bool(messages) and self.messages.has_before(messages[0])
+        })
+
+    '''
+    Sends a page of messages which a client asked for, see ChatRoomServer.send_history
+    '''
+    def send_history(self, client: AsyncClient, packet: dict):
+        try:
+            limit = max(1, min(int(packet.get("limit", self.history_page_size)), self.history_page_size))
+        except (TypeError, ValueError):
+            limit = self.history_page_size
+
+        response = {
+            "header": "history"
+        }
+
+        if "before" in packet:
+            messages = self.messages.before(packet["before"], limit)
+            response["before"] = packet["before"]
+            response["more"] = bool(messages) and self.messages.has_before(messages[0])
+        elif "after" in packet:
+            messages = self.messages.after(packet["after"], limit)
+            response["after"] = packet["after"]
+            response["more"] = bool(messages) and self.messages.has_after(messages[-1])
+        else:
+            messages = self.messages.last(limit)
+            response["more"] = bool(messages) and self.messages.has_before(messages[0])
+
+        response["array"] = [message.build_packet() for message in messages]
+        client.send_packet(response)
+
+if __name__ == "__main__":
+    server = AsyncChatRoomServer(socket.gethostname(), 1024)
+    asyncio.run(server.start())
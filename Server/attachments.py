@@ -0,0 +1,303 @@
+
+from networking import FRAME_HEADER
+from rate_limiting import TokenBucket
+from metrics import Metrics
+from threading import Thread, Lock
+import hashlib
+import secrets
+import socket
+import json
+import time
+import os
+
+'''
+Attachment constants
+- UPLOAD / DOWNLOAD: The two kinds of transfer a client can be granted
+- TRANSFER_TOKEN_TTL: How many seconds a client has to open the transfer connection it was granted
+- TRANSFER_TIMEOUT: How many seconds a transfer connection can go without moving any data before it is dropped
+- TRANSFER_CHUNK_SIZE: How many bytes are moved at a time, the transfer rate limit is checked between chunks
+- MAX_REQUEST_SIZE: The largest transfer request accepted at the start of a transfer connection
+'''
+UPLOAD = "upload"
+DOWNLOAD = "download"
+TRANSFER_TOKEN_TTL = 60
+TRANSFER_TIMEOUT = 30
+TRANSFER_CHUNK_SIZE = 1024 * 1024
+MAX_REQUEST_SIZE = 4096
+
+BYTES_UPLOADED = Metrics.counter("chatroom_attachment_bytes_uploaded_total", "Attachment bytes received from clients")
+BYTES_DOWNLOADED = Metrics.counter("chatroom_attachment_bytes_downloaded_total", "Attachment bytes sent to clients")
+
+'''
+Reads exactly the given amount of bytes from a socket, returns None if the connection closes first
+'''
+def recv_exactly(sock: socket.socket, length: int):
+    data = b""
+
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+
+        if not chunk:
+            return None
+
+        data += chunk
+
+    return data
+
+'''
+AttachmentStore Class
+- Stores attachments on disk named after the SHA-256 of their content, so a file uploaded any number of times is
+only stored once and a hash always refers to the same bytes
+- Uploads are written to a partial file first and only moved into the store once their hash has been checked, an
+interrupted upload keeps its partial file so it can be resumed from where it stopped
+'''
+class AttachmentStore:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.uploading = set()
+        self.lock = Lock()
+
+        os.makedirs(os.path.join(directory, "objects"), exist_ok = True)
+        os.makedirs(os.path.join(directory, "partial"), exist_ok = True)
+
+    '''
+    Checks that a value is a hex SHA-256, the only form of name the store accepts
+    '''
+    @staticmethod
+    def is_hash(value: str):
+        return isinstance(value, str) and len(value) == 64 and all(char in "0123456789abcdef" for char in value)
+
+    def path(self, digest: str):
+        return os.path.join(self.directory, "objects", digest[:2], digest)
+
+    def partial_path(self, digest: str):
+        return os.path.join(self.directory, "partial", digest)
+
+    '''
+    Returns the size of a stored attachment, or None if the store does not have it
+    '''
+    def size(self, digest: str):
+        try:
+            return os.path.getsize(self.path(digest))
+        except OSError:
+            return None
+
+    '''
+    Returns how many bytes of an interrupted upload the store already has
+    '''
+    def received(self, digest: str):
+        try:
+            return os.path.getsize(self.partial_path(digest))
+        except OSError:
+            return 0
+
+    '''
+    Claims an upload so only one connection writes to its partial file at a time, returns False if it is taken
+    '''
+    def claim(self, digest: str):
+        with self.lock:
+            if digest in self.uploading:
+                return False
+
+            self.uploading.add(digest)
+            return True
+
+    def release(self, digest: str):
+        with self.lock:
+            self.uploading.discard(digest)
+
+    '''
+    Opens the partial file of an upload to continue it from the given offset, returns the file and the hash of
+    everything before the offset
+    - The partial file is cut down to the offset, anything after it is sent again
+    '''
+    def open_partial(self, digest: str, offset: int):
+        file = open(self.partial_path(digest), "a+b")
+        file.truncate(offset)
+        file.seek(0)
+        hasher = hashlib.sha256()
+
+        while chunk := file.read(TRANSFER_CHUNK_SIZE):
+            hasher.update(chunk)
+
+        return file, hasher
+
+    '''
+    Moves a finished upload into the store if its content matches its hash, returns whether it did
+    - An upload which does not match is thrown away, it would have to be sent again from the start anyway
+    '''
+    def complete(self, digest: str, hasher):
+        if hasher.hexdigest() != digest:
+            os.remove(self.partial_path(digest))
+            return False
+
+        os.makedirs(os.path.dirname(self.path(digest)), exist_ok = True)
+        os.replace(self.partial_path(digest), self.path(digest))
+
+        return True
+
+'''
+TransferGrant Class
+- Permission for a client to upload or download a single attachment, handed out over the chat connection and
+redeemed once by opening a transfer connection
+'''
+class TransferGrant:
+    def __init__(self, client, kind: str, digest: str, size: int):
+        self.client = client
+        self.kind = kind
+        self.digest = digest
+        self.size = size
+        self.expires = time.monotonic() + TRANSFER_TOKEN_TTL
+
+'''
+TransferServer Class
+- Moves attachment bytes over connections of their own, so a large transfer never sits in front of chat packets in a
+client's send queue and TCP flow controls every transfer separately
+- A transfer connection starts with a single framed JSON request holding the token of a grant and the offset to
+start from, after which only raw file bytes are sent
+- Downloads are sent straight from the file with sendfile, so their bytes never pass through Python
+- rate: The most bytes per second a single transfer may move, None for no limit
+'''
+class TransferServer:
+    def __init__(self, ip: str, port: int, store: AttachmentStore, on_uploaded, rate: float = None):
+        self.sock = socket.create_server((ip, port))
+        self.port = self.sock.getsockname()[1]
+        self.store = store
+        self.on_uploaded = on_uploaded
+        self.rate = rate
+        self.grants = {}
+        self.lock = Lock()
+
+    '''
+    Starts the thread which accepts transfer connections
+    '''
+    def start(self):
+        Thread(target = self.accept_loop, daemon = True).start()
+
+    '''
+    Grants a client a transfer, returns the token the client has to open the transfer connection with
+    - Grants which were never redeemed are dropped once they expire
+    '''
+    def grant(self, client, kind: str, digest: str, size: int):
+        token = secrets.token_hex(16)
+        now = time.monotonic()
+
+        with self.lock:
+            for expired in [key for key, grant in self.grants.items() if grant.expires < now]:
+                del self.grants[expired]
+
+            self.grants[token] = TransferGrant(client, kind, digest, size)
+
+        return token
+
+    def accept_loop(self):
+        while True:
+            conn, addr = self.sock.accept()
+            Thread(target = self.transfer, args = (conn,), daemon = True).start()
+
+    '''
+    Runs a single transfer connection
+    - Connections without a valid token are closed without a reply
+    '''
+    def transfer(self, conn: socket.socket):
+        with conn:
+            try:
+                conn.settimeout(TRANSFER_TIMEOUT)
+                header = recv_exactly(conn, FRAME_HEADER.size)
+
+                if header is None:
+                    return
+
+                (length,) = FRAME_HEADER.unpack(header)
+
+                if length > MAX_REQUEST_SIZE:
+                    return
+
+                request = json.loads(recv_exactly(conn, length) or b"null")
+                offset = request["offset"]
+
+                with self.lock:
+                    grant = self.grants.pop(request["token"], None)
+
+                if grant is None or grant.expires < time.monotonic() or not isinstance(offset, int):
+                    return
+
+                if grant.kind == UPLOAD:
+                    self.receive_upload(conn, grant, offset)
+                else:
+                    self.send_download(conn, grant, offset)
+            except (OSError, ValueError, TypeError, KeyError):
+                pass
+
+    '''
+    Receives an upload into its partial file, starting from the offset the client asked for
+    - The offset cannot be past what the store already has, an upload which is cut short stays partial
+    '''
+    def receive_upload(self, conn: socket.socket, grant: TransferGrant, offset: int):
+        if not 0 <= offset <= min(self.store.received(grant.digest), grant.size) or not self.store.claim(grant.digest):
+            return
+
+        try:
+            file, hasher = self.store.open_partial(grant.digest, offset)
+            bucket = self.create_bucket()
+            buffer = memoryview(bytearray(TRANSFER_CHUNK_SIZE))
+            remaining = grant.size - offset
+
+            with file:
+                while remaining:
+                    length = conn.recv_into(buffer[:min(remaining, TRANSFER_CHUNK_SIZE)])
+
+                    if not length:
+                        return
+
+                    file.write(buffer[:length])
+                    hasher.update(buffer[:length])
+                    remaining -= length
+                    BYTES_UPLOADED.increment(length)
+                    self.throttle(bucket, length)
+
+            if self.store.complete(grant.digest, hasher):
+                self.on_uploaded(grant.client, grant.digest, grant.size)
+        finally:
+            self.store.release(grant.digest)
+
+    '''
+    Sends a stored attachment from the offset the client asked for, one chunk at a time with sendfile
+    '''
+    def send_download(self, conn: socket.socket, grant: TransferGrant, offset: int):
+        size = self.store.size(grant.digest)
+
+        if size is None or not 0 <= offset <= size:
+            return
+
+        bucket = self.create_bucket()
+
+        with open(self.store.path(grant.digest), "rb") as file:
+            while offset < size:
+                sent = conn.sendfile(file, offset, min(TRANSFER_CHUNK_SIZE, size - offset))
+
+                if not sent:
+                    return
+
+                offset += sent
+                BYTES_DOWNLOADED.increment(sent)
+                self.throttle(bucket, sent)
+
+    '''
+    Creates the token bucket which limits the rate of a single transfer, or None if transfers are not limited
+    '''
+    def create_bucket(self):
+        if self.rate is None:
+            return None
+
+        return TokenBucket(self.rate, TRANSFER_CHUNK_SIZE)
+
+    '''
+    Waits until a transfer is allowed to move the bytes it just moved
+    '''
+    def throttle(self, bucket: TokenBucket, length: int):
+        if bucket is None:
+            return
+
+        while not bucket.consume(length):
+            time.sleep(bucket.wait_time(length))
@@ -0,0 +1,353 @@
+
+from server import ChatRoomServer
+from async_server import AsyncChatRoomServer
+from rate_limiting import TokenBucket
+from rooms import DEFAULT_ROOM
+from networking import FrameBuffer
+from multiprocessing import Process
+import argparse
+import asyncio
+import resource
+import socket
+import random
+import json
+import time
+
+'''
+Benchmark constants
+- UNLIMITED: Rate used for every token bucket, the benchmark measures the engine rather than the flood protection
+- CONNECT_CONCURRENCY: How many simulated clients may be connecting and joining at the same time, kept below the
+threaded engine's listen backlog so connections are not dropped and retried by the kernel
+'''
+UNLIMITED = float("inf")
+CONNECT_CONCURRENCY = 4
+
+'''
+Starts the threaded engine from server.py in the current process
+'''
+def run_threaded_server(ip: str, port: int):
+    raise_file_limit()
+
+    server = ChatRoomServer(ip, port)
+    server.message_rate = server.message_burst = UNLIMITED
+    server.join_rate = server.join_burst = UNLIMITED
+    server.room_message_rate = server.room_message_burst = UNLIMITED
+    server.room_join_rate = server.room_join_burst = UNLIMITED
+    server.rooms[DEFAULT_ROOM].message_bucket = TokenBucket(UNLIMITED, UNLIMITED)
+    server.rooms[DEFAULT_ROOM].join_bucket = TokenBucket(UNLIMITED, UNLIMITED)
+
+    server.start()
+
+'''
+Starts the asyncio engine from async_server.py in the current process
+'''
+def run_async_server(ip: str, port: int):
+    raise_file_limit()
+
+    server = AsyncChatRoomServer(ip, port)
+    asyncio.run(server.start())
+
+'''
+Every engine the benchmark can run, by name
+'''
+ENGINES = {
+    "threaded": run_threaded_server,
+    "async": run_async_server
+}
+
+'''
+Raises the open file limit as far as allowed, every simulated client needs a socket
+'''
+def raise_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+'''
+Returns a port which is free on the given address
+'''
+def free_port(ip: str):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((ip, 0))
+        return sock.getsockname()[1]
+
+'''
+Waits until a server is accepting connections on the given port
+'''
+def wait_for_server(ip: str, port: int, timeout: float):
+    deadline = time.monotonic() + timeout
+
+    while True:
+        try:
+            socket.create_connection((ip, port), timeout).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+
+            time.sleep(0.05)
+
+'''
+Reads the resident memory in bytes and thread count of a process, or None on platforms without /proc
+'''
+def process_stats(pid: int):
+    stats = {
+        "rss": None,
+        "threads": None
+    }
+
+    try:
+        with open(f"/proc/{pid}/status") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    stats["rss"] = int(line.split()[1]) * 1024
+                elif line.startswith("Threads:"):
+                    stats["threads"] = int(line.split()[1])
+    except OSError:
+        pass
+
+    return stats
+
+'''
+Summarises a list of latencies in seconds as milliseconds
+'''
+def percentiles(samples: list):
+    if not samples:
+        return None
+
+    samples = sorted(samples)
+    pick = lambda q: round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000, 3)
+
+    return {
+        "count": len(samples),
+        "p50": pick(0.5),
+        "p99": pick(0.99),
+        "p999": pick(0.999),
+        "max": round(samples[-1] * 1000, 3)
+    }
+
+'''
+SimulatedClient Class
+- Headless client which speaks the same framed JSON packets as ChatRoomClient
+- Many of them share a single event loop, so thousands can be run from one process
+- Messages carry the time they were sent, so every client which receives one can work out the fan-out latency
+'''
+class SimulatedClient:
+    def __init__(self, index: int, benchmark):
+        self.index = index
+        self.name = f"bench-{index}"
+        self.benchmark = benchmark
+        self.reader = None
+        self.writer = None
+        self.joined = asyncio.Event()
+        self.task = None
+
+    '''
+    Connects to the server and sends the user, returns once the server has confirmed the join
+    '''
+    async def join(self, ip: str, port: int):
+        started = time.perf_counter()
+        self.reader, self.writer = await asyncio.open_connection(ip, port)
+        self.task = asyncio.ensure_future(self.listen())
+
+        self.send_packet({
+            "header": "user",
+            "id": -1,
+            "name": self.name
+        })
+
+        await self.joined.wait()
+        self.benchmark.join_latencies.append(time.perf_counter() - started)
+
+    '''
+    Sends a message stamped with the time it was sent
+    '''
+    def send_message(self):
+        self.send_packet({
+            "header": "message",
+            "id": -1,
+            "content": f"{self.index} {time.perf_counter()}",
+            "sender": {
+                "id": -1,
+                "name": self.name
+            }
+        })
+
+    def send_packet(self, packet: dict):
+        self.writer.write(FrameBuffer.encode_frame(json.dumps(packet).encode()))
+
+    '''
+    Receives packets until the connection closes
+    - Answers heartbeats so the server does not reap idle simulated clients
+    '''
+    async def listen(self):
+        framebuffer = FrameBuffer()
+
+        while True:
+            try:
+                data = await self.reader.read(65536)
+            except OSError:
+                return
+
+            if not data:
+                return
+
+            framebuffer.feed(data)
+
+            while (frame := framebuffer.next_frame()) is not None:
+                self.handle_packet(json.loads(frame.decode()))
+
+    def handle_packet(self, packet: dict):
+        if packet["header"] == "user" and packet.get("is-me"):
+            self.joined.set()
+        elif packet["header"] == "message":
+            sent = float(packet["content"].split()[1])
+            self.benchmark.delivered(time.perf_counter() - sent)
+        elif packet["header"] == "ping":
+            self.send_packet({
+                "header": "pong"
+            })
+
+    '''
+    Closes the connection
+    '''
+    async def leave(self):
+        self.writer.close()
+
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+        await self.task
+
+'''
+Benchmark Class
+- Starts a server engine in its own process and runs a scripted join, chat and leave workload against it
+- Every client joins the default room, a subset of them send messages which are fanned out to every client
+- The server process is measured from the outside, so the simulated clients do not count towards its memory
+'''
+class Benchmark:
+    def __init__(self, engine: str, clients: int, senders: int, messages: int, rate: float, ip: str = "127.0.0.1", timeout: float = 60):
+        self.engine = engine
+        self.clients = clients
+        self.senders = min(senders, clients)
+        self.messages = messages
+        self.rate = rate
+        self.ip = ip
+        self.timeout = timeout
+
+        self.join_latencies = []
+        self.fanout_latencies = []
+        self.expected_deliveries = self.senders * self.messages * self.clients
+        self.all_delivered = None
+
+    '''
+    Records a message being received by a simulated client
+    '''
+    def delivered(self, latency: float):
+        self.fanout_latencies.append(latency)
+
+        if len(self.fanout_latencies) >= self.expected_deliveries:
+            self.all_delivered.set()
+
+    '''
+    Runs the whole benchmark and returns the results as a dictionary
+    '''
+    def run(self):
+        raise_file_limit()
+
+        port = free_port(self.ip)
+        server = Process(target = ENGINES[self.engine], args = (self.ip, port), daemon = True)
+        server.start()
+
+        try:
+            wait_for_server(self.ip, port, self.timeout)
+            time.sleep(0.5)
+            return asyncio.run(self.workload(port, server.pid))
+        finally:
+            server.terminate()
+            server.join()
+
+    async def workload(self, port: int, pid: int):
+        self.all_delivered = asyncio.Event()
+        baseline = process_stats(pid)
+        clients = [SimulatedClient(index, self) for index in range(self.clients)]
+        semaphore = asyncio.Semaphore(CONNECT_CONCURRENCY)
+
+        async def join(client: SimulatedClient):
+            async with semaphore:
+                await asyncio.wait_for(client.join(self.ip, port), self.timeout)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(join(client) for client in clients))
+        join_duration = time.perf_counter() - started
+        joined = process_stats(pid)
+
+        async def chat(client: SimulatedClient):
+            await asyncio.sleep(random.random() / self.rate)
+
+            for _ in range(self.messages):
+                client.send_message()
+                await asyncio.sleep(1 / self.rate)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(chat(client) for client in random.sample(clients, self.senders)))
+
+        try:
+            await asyncio.wait_for(self.all_delivered.wait(), self.timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        chat_duration = time.perf_counter() - started
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client.leave() for client in clients))
+        leave_duration = time.perf_counter() - started
+
+        memory_per_connection = None
+
+        if baseline["rss"] is not None and joined["rss"] is not None:
+            memory_per_connection = round((joined["rss"] - baseline["rss"]) / self.clients)
+
+        return {
+            "engine": self.engine,
+            "clients": self.clients,
+            "senders": self.senders,
+            "messages_per_sender": self.messages,
+            "send_rate": self.rate,
+            "join_duration": round(join_duration, 3),
+            "chat_duration": round(chat_duration, 3),
+            "leave_duration": round(leave_duration, 3),
+            "messages_sent": self.senders * self.messages,
+            "deliveries": len(self.fanout_latencies),
+            "expected_deliveries": self.expected_deliveries,
+            "messages_per_second": round(self.senders * self.messages / chat_duration, 1),
+            "deliveries_per_second": round(len(self.fanout_latencies) / chat_duration, 1),
+            "join_latency_ms": percentiles(self.join_latencies),
+            "fanout_latency_ms": percentiles(self.fanout_latencies),
+            "server_rss_bytes": joined["rss"],
+            "memory_per_connection_bytes": memory_per_connection,
+            "server_threads": joined["threads"]
+        }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Runs a join, chat and leave workload against a local chat room server")
+    parser.add_argument("--engine", choices = sorted(ENGINES), default = "threaded")
+    parser.add_argument("--clients", type = int, default = 1000, help = "simulated clients which join the room")
+    parser.add_argument("--senders", type = int, default = 50, help = "clients which send messages")
+    parser.add_argument("--messages", type = int, default = 10, help = "messages sent by each sender")
+    parser.add_argument("--rate", type = float, default = 5, help = "messages per second sent by each sender")
+    parser.add_argument("--timeout", type = float, default = 60, help = "seconds to wait for joins and deliveries")
+    parser.add_argument("--output", help = "file to write the JSON results to, defaults to stdout")
+    args = parser.parse_args()
+
+    benchmark = Benchmark(args.engine, args.clients, args.senders, args.messages, args.rate, timeout = args.timeout)
+    results = json.dumps(benchmark.run(), indent = 4)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(results + "\n")
+    else:
+        print(results)
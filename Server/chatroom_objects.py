@@ -1,69 +1,153 @@
 
-import random
+from threading import Lock
+import weakref
+import time
 
 '''
 Object ID Generator
 - Generates IDs for objects such as users or messages
-- Keeps track of generated IDs so there is no repetition
-- Repetition of IDs is extremely unlikely, however this will still account for it
+- IDs are 64 bit integers made of a millisecond timestamp, a worker ID and a per millisecond sequence number
+- IDs only ever increase, so sorting objects by ID sorts them by the time they were created
+- No IDs are stored, generating an ID is O(1) and safe to call from any thread
+- Each process that generates IDs for the same chat room should be given its own worker ID
 '''
 class ObjectIDGenerator:
-    ids = []
+    EPOCH = 1640995200000
+    WORKER_BITS = 10
+    SEQUENCE_BITS = 12
+
+    worker_id = 0
+    last_timestamp = -1
+    sequence = 0
+    lock = Lock()
 
     @classmethod
     def generate_id(cls):
-        id = random.randint(1000000000, 9999999999)
+        with cls.lock:
+            timestamp = max(int(time.time() * 1000) - cls.EPOCH, cls.last_timestamp)
+
+            if timestamp == cls.last_timestamp:
+                cls.sequence = (cls.sequence + 1) & ((1 << cls.SEQUENCE_BITS) - 1)
+
+                # Sequence exhausted for this millisecond, borrow the next one instead of waiting for it
+                if cls.sequence == 0:
+                    timestamp += 1
+            else:
+                cls.sequence = 0
+
+            cls.last_timestamp = timestamp
+
+            return (timestamp << (cls.WORKER_BITS + cls.SEQUENCE_BITS)) | (cls.worker_id << cls.SEQUENCE_BITS) | cls.sequence
 
-        if id in cls.ids:
-            return cls.generate_id()
-        else:
-            cls.ids.append(id)
-            return id
+    '''
+    Sets the worker ID which is embedded in every ID generated by this process
+    '''
+    @classmethod
+    def set_worker_id(cls, worker_id: int):
+        if not 0 <= worker_id < (1 << cls.WORKER_BITS):
+            raise ValueError(f"Worker ID must be between 0 and {(1 << cls.WORKER_BITS) - 1}")
+
+        cls.worker_id = worker_id
 
 '''
 User Class
 - Stores information about a user such as the ID and name
+- Slotted, and every message sent by a user points at the same User object instead of a copy of it
+- Users are interned by ID, so users rebuilt from the message log or the cluster bus share the object already in use
+- The JSON form is built once and cached, it is rebuilt if the ID changes and must not be modified by callers
 '''
 class User:
+    __slots__ = ("name", "_id", "json", "__weakref__")
+
+    interned = weakref.WeakValueDictionary()
+
     def __init__(self, name: str):
         self.name = name
-        self.id = -1
+        self._id = -1
+        self.json = None
+
+    @property
+    def id(self):
+        return self._id
+
+    @id.setter
+    def id(self, value: int):
+        self._id = value
+        self.json = None
 
     def build_json(self):
-        return {
-            "id": self.id,
-            "name": self.name
-        }
+        if self.json is None:
+            self.json = {
+                "id": self._id,
+                "name": self.name
+            }
 
-    def build_packet(self):
-        data = self.build_json()
-        data["header"] = "user"
+        return self.json
 
-        return data
+    def build_packet(self):
+        return {**self.build_json(), "header": "user"}
 
     def from_packet(packet: dict):
         return User(packet["name"])
 
+    '''
+    Makes a user the object shared by everything which refers to its ID
+    '''
+    @classmethod
+    def register(cls, user):
+        cls.interned[user.id] = user
+
+    '''
+    Returns the shared user with the given ID, creating it if there isn't one
+    '''
+    @classmethod
+    def intern(cls, user_id: int, name: str):
+        user = cls.interned.get(user_id)
+
+        if user is None or user.name != name:
+            user = User(name)
+            user.id = user_id
+            cls.interned[user_id] = user
+
+        return user
+
 '''
 Message Class
 - Stores information about a message such as the ID, the content of the message and the user that sent it
+- Slotted, since the history holds thousands of them, the sender's cached JSON is reused in every packet
+- A message can refer to an attachment by the hash it is stored under, packets only include it when there is one
 '''
 class Message:
+    __slots__ = ("content", "sender", "id", "attachment")
+
     def __init__(self, content: str, sender: User):
         self.content = content
         self.sender = sender
         self.id = -1
+        self.attachment = None
 
     def build_json(self):
-        return {
+        data = {
             "id": self.id,
             "content": self.content,
             "sender": self.sender.build_json()
         }
 
+        if self.attachment is not None:
+            data["attachment"] = self.attachment
+
+        return data
+
     def build_packet(self):
-        data = self.build_json()
-        data["header"] = "message"
+        data = {
+            "id": self.id,
+            "content": self.content,
+            "sender": self.sender.build_json(),
+            "header": "message"
+        }
+
+        if self.attachment is not None:
+            data["attachment"] = self.attachment
 
         return data
 
@@ -77,6 +161,8 @@ Announcement Class
 inform all connected clients of this
 '''
 class Announcement:
+    __slots__ = ("content",)
+
     def __init__(self, content: str):
         self.content = content
 
@@ -86,10 +172,10 @@ class Announcement:
         }
 
     def build_packet(self):
-        data = self.build_json()
-        data["header"] = "announcement"
-
-        return data
+        return {
+            "content": self.content,
+            "header": "announcement"
+        }
 
     def from_packet(packet: dict):
         return Announcement(packet["content"])
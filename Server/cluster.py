@@ -0,0 +1,253 @@
+
+from server import *
+from multiprocessing import Process
+from threading import Thread, Lock
+import tempfile
+import socket
+import json
+import sys
+import os
+
+'''
+Reads frames from a unix domain socket connection until it closes
+'''
+def recv_frames(sock: socket.socket):
+    framebuffer = FrameBuffer()
+
+    while True:
+        frame = framebuffer.next_frame()
+
+        if frame is not None:
+            yield frame
+            continue
+
+        data = sock.recv(65536)
+
+        if not data:
+            return
+
+        framebuffer.feed(data)
+
+'''
+MessageBus Class
+- Local publish/subscribe bus which links the worker processes of a cluster together over a unix domain socket
+- Every event published by a worker is sent to every worker, including the one that published it
+- Events are forwarded one at a time under a single lock, so every worker receives every event in the same order
+'''
+class MessageBus:
+    def __init__(self, path: str):
+        self.path = path
+        self.workers = {}
+        self.lock = Lock()
+
+        if os.path.exists(path):
+            os.unlink(path)
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(64)
+
+    '''
+    Accepts worker connections and forwards their events forever
+    '''
+    def serve(self):
+        while True:
+            conn, _ = self.sock.accept()
+            Thread(target = self.worker_listener, args = (conn,), daemon = True).start()
+
+    '''
+    Receives events from a single worker and forwards them to every worker
+    - The first frame from a worker is its hello event, which says which worker it is
+    - Once a worker disconnects, the remaining workers are told so they can remove its users
+    '''
+    def worker_listener(self, conn: socket.socket):
+        frames = recv_frames(conn)
+        hello = json.loads(next(frames, b'{"worker": -1}').decode())
+        worker_id = hello["worker"]
+
+        with self.lock:
+            self.workers[conn] = worker_id
+
+        for frame in frames:
+            self.publish(FrameBuffer.encode_frame(frame))
+
+        with self.lock:
+            self.workers.pop(conn, None)
+
+        conn.close()
+
+        packet = {
+            "event": "worker-down",
+            "worker": worker_id
+        }
+
+        self.publish(FrameBuffer.encode_frame(json.dumps(packet).encode()))
+
+    '''
+    Sends a framed event to every connected worker
+    '''
+    def publish(self, frame: bytes):
+        with self.lock:
+            for conn in list(self.workers):
+                try:
+                    conn.sendall(frame)
+                except OSError:
+                    self.workers.pop(conn, None)
+
+'''
+ClusterChatRoomServer Class, a ChatRoomServer which runs as one worker process of a cluster
+- Every worker listens on the same port with SO_REUSEPORT, so the kernel spreads clients across the workers
+- Joins, leaves, messages and direct messages are published to the message bus instead of being applied straight
+away, and are applied once the bus sends them back, so every worker sees the same events in the same order
+- Users connected to other workers are kept in each room's roster so users packets list the whole room
+'''
+class ClusterChatRoomServer(ChatRoomServer):
+    def __init__(self, ip: str, port: int, worker_id: int, bus_path: str, history_capacity: int = 1000, log_directory: str = None):
+        ObjectIDGenerator.set_worker_id(worker_id)
+
+        if log_directory is not None:
+            log_directory = os.path.join(log_directory, f"worker-{worker_id}")
+
+        super().__init__(ip, port, history_capacity, log_directory, reuse_port = True)
+
+        self.worker_id = worker_id
+        self.bus = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.bus.connect(bus_path)
+        self.bus_lock = Lock()
+
+        self.send_event({
+            "event": "hello",
+            "worker": worker_id
+        })
+
+        Thread(target = self.bus_listener, daemon = True).start()
+
+    '''
+    Sends an event to the message bus
+    '''
+    def send_event(self, event: dict):
+        frame = FrameBuffer.encode_frame(json.dumps(event).encode())
+
+        with self.bus_lock:
+            self.bus.sendall(frame)
+
+    def publish_join(self, user: User, room: Room):
+        self.send_event({
+            "event": "join",
+            "room": room.name,
+            "user": user.build_json()
+        })
+
+    def publish_leave(self, user: User, room: Room):
+        self.send_event({
+            "event": "leave",
+            "room": room.name,
+            "user": user.build_json()
+        })
+
+    def publish_message(self, message: Message, room: Room):
+        self.send_event({
+            "event": "message",
+            "room": room.name,
+            "message": message.build_json()
+        })
+
+    def publish_direct_message(self, message: Message, participants: tuple):
+        self.send_event({
+            "event": "direct-message",
+            "participants": list(participants),
+            "message": message.build_json()
+        })
+
+    '''
+    Users connected to other workers are online if they are in the default room's roster
+    '''
+    def user_online(self, user_id: int):
+        return super().user_online(user_id) or user_id in self.rooms[DEFAULT_ROOM].members.roster
+
+    '''
+    Applies the events sent by the message bus in the order they arrive
+    - The worker exits if the bus goes away, since it can no longer keep its rooms in sync
+    '''
+    def bus_listener(self):
+        for frame in recv_frames(self.bus):
+            event = json.loads(frame.decode())
+
+            if event["event"] == "worker-down":
+                self.worker_down(event["worker"])
+                continue
+
+            if event["event"] == "direct-message":
+                self.direct_message_sent(self.decode_message(event["message"]), tuple(event["participants"]))
+                continue
+
+            with self.rooms_lock:
+                room = self.get_room(event["room"]) if event["event"] == "join" else self.rooms.get(event["room"])
+
+            if room is None:
+                continue
+
+            if event["event"] == "join":
+                self.user_joined(self.decode_user(event["user"]), room)
+            elif event["event"] == "leave":
+                self.user_left(self.decode_user(event["user"]), room)
+            elif event["event"] == "message":
+                self.message_sent(self.decode_message(event["message"]), room)
+
+        os._exit(1)
+
+    '''
+    Removes every user of a worker which has stopped from the rooms
+    - The worker a user is connected to is part of the user's ID
+    '''
+    def worker_down(self, worker_id: int):
+        worker_mask = (1 << ObjectIDGenerator.WORKER_BITS) - 1
+
+        for room in list(self.rooms.values()):
+            for user_id, data in list(room.members.roster.items()):
+                if (user_id >> ObjectIDGenerator.SEQUENCE_BITS) & worker_mask == worker_id:
+                    self.user_left(self.decode_user(json.loads(data)), room)
+
+    '''
+    Rebuilds a user, including its ID, from an event
+    - Returns the user already in use for that ID if there is one, messages from the same user share one object
+    '''
+    def decode_user(self, data: dict):
+        return User.intern(data["id"], data["name"])
+
+    '''
+    Rebuilds a message, including its ID and attachment, from an event
+    '''
+    def decode_message(self, data: dict):
+        message = Message(data["content"], self.decode_user(data["sender"]))
+        message.id = data["id"]
+        message.attachment = data.get("attachment")
+
+        return message
+
+'''
+Runs a single worker process of a cluster
+'''
+def run_worker(ip: str, port: int, worker_id: int, bus_path: str, history_capacity: int, log_directory: str):
+    server = ClusterChatRoomServer(ip, port, worker_id, bus_path, history_capacity, log_directory)
+    server.start()
+
+'''
+Starts a cluster of worker processes which all serve the same port
+- The calling process runs the message bus which links the workers together
+'''
+def run_cluster(ip: str, port: int, workers: int = os.cpu_count(), history_capacity: int = 1000, log_directory: str = None, bus_path: str = None):
+    if bus_path is None:
+        bus_path = os.path.join(tempfile.gettempdir(), f"chatroom-{port}.sock")
+
+    bus = MessageBus(bus_path)
+
+    for worker_id in range(workers):
+        args = (ip, port, worker_id, bus_path, history_capacity, log_directory)
+        Process(target = run_worker, args = args, daemon = True).start()
+
+    bus.serve()
+
+if __name__ == "__main__":
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count()
+    run_cluster(socket.gethostname(), 1024, workers)
@@ -0,0 +1,76 @@
+
+from chatroom_objects import *
+from history import MessageHistory
+from threading import Lock
+
+'''
+Conversation constants
+- MAX_RECIPIENTS: The most users a single direct message can be sent to, a conversation is its recipients and the
+sender so it can have one more participant than this
+'''
+MAX_RECIPIENTS = 8
+
+'''
+Conversation Class
+- A private conversation between two or more users, kept apart from the rooms and their message logs
+- Identified by the sorted IDs of its participants, so a message to the same users always ends up in the same
+conversation whichever of them sent it
+'''
+class Conversation:
+    def __init__(self, participants: tuple, history_capacity: int):
+        self.participants = participants
+        self.messages = MessageHistory(history_capacity)
+
+    '''
+    Returns the participants of the conversation between the given users
+    '''
+    @staticmethod
+    def key(user_ids: list):
+        return tuple(sorted(set(user_ids)))
+
+'''
+ConversationStore Class
+- Stores the conversations of the users connected to this server, looked up by their participants in O(1)
+- A conversation is dropped once every participant connected to this server has disconnected, user IDs are handed
+out per connection so nobody could ask for it again
+'''
+class ConversationStore:
+    def __init__(self, history_capacity: int = 100):
+        self.history_capacity = history_capacity
+        self.conversations = {}
+        self.by_user = {}
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.conversations)
+
+    '''
+    Returns the conversation between the given participants, or None if there isn't one
+    '''
+    def get(self, participants: tuple):
+        return self.conversations.get(participants)
+
+    '''
+    Stores a message in a conversation, creating the conversation if it does not exist yet
+    - local_ids: The participants connected to this server, the conversation is kept until all of them disconnect
+    '''
+    def store(self, participants: tuple, message: Message, local_ids: list):
+        with self.lock:
+            conversation = self.conversations.get(participants)
+
+            if conversation is None:
+                conversation = self.conversations[participants] = Conversation(participants, self.history_capacity)
+
+            for user_id in local_ids:
+                self.by_user.setdefault(user_id, set()).add(participants)
+
+            conversation.messages.append(message)
+
+    '''
+    Forgets a user which has disconnected, dropping the conversations nobody else on this server is part of
+    '''
+    def remove_user(self, user_id: int):
+        with self.lock:
+            for participants in self.by_user.pop(user_id, ()):
+                if not any(participants in self.by_user.get(other, ()) for other in participants):
+                    del self.conversations[participants]
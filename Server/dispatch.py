@@ -0,0 +1,195 @@
+
+from metrics import Metrics
+from collections import deque
+from threading import Lock, RLock, current_thread
+import cProfile
+import pstats
+import time
+import io
+
+'''
+Profiler constants
+- PROFILE_SORT_KEYS: The orders a profile can be printed in
+- PROFILE_LIMIT: The most functions printed from a profile unless another limit is asked for
+'''
+PROFILE_SORT_KEYS = ("cumulative", "tottime", "calls")
+PROFILE_LIMIT = 30
+
+'''
+Returns a function which calls a middleware with the rest of the chain after it
+'''
+def wrap(middleware, call_next):
+    return lambda *args: middleware(call_next, *args)
+
+'''
+PacketDispatcher Class
+- Maps packet headers to the functions which handle them, a new packet type is added by registering a handler for
+its header instead of adding another branch to a chain of ifs
+- Finding the handler is a single dictionary lookup however many packet types there are
+- The arguments passed to dispatch are passed on to the middleware and the handler, the packet is always the last
+- Middleware wraps every handler call, each one is called as middleware(call_next, *args) and either calls
+call_next(*args) to carry on or returns without calling it to drop the packet, the first added runs first
+- Packets without a registered handler are ignored before any middleware runs
+'''
+class PacketDispatcher:
+    def __init__(self):
+        self.handlers = {}
+        self.middleware = []
+        self.chain = self.call_handler
+
+    '''
+    Sets the handler for packets with the given header, replacing any handler it had before
+    '''
+    def register(self, header: str, handler):
+        self.handlers[header] = handler
+
+    '''
+    Adds a middleware after every middleware added so far
+    - The chain is built once here, dispatching a packet does not walk the list of middleware
+    '''
+    def use(self, middleware):
+        self.middleware.append(middleware)
+        self.chain = self.call_handler
+
+        for middleware in reversed(self.middleware):
+            self.chain = wrap(middleware, self.chain)
+
+    '''
+    Passes a packet through the middleware to the handler registered for its header
+    '''
+    def dispatch(self, *args):
+        header = args[-1].get("header")
+
+        if isinstance(header, str) and header in self.handlers:
+            self.chain(*args)
+
+    def call_handler(self, *args):
+        self.handlers[args[-1]["header"]](*args)
+
+'''
+HandlerTimer Class
+- Middleware which records a latency histogram for every packet type, the count of the histogram is the amount of
+times the packet type was handled
+- Histograms are created the first time each header is handled and are served with the rest of the metrics
+- Only headers with a registered handler reach middleware, so clients cannot create metrics by making headers up
+'''
+class HandlerTimer:
+    def __init__(self, prefix: str = "chatroom_handler"):
+        self.prefix = prefix
+        self.histograms = {}
+        self.lock = Lock()
+
+    def __call__(self, call_next, *args):
+        started = time.perf_counter()
+
+        try:
+            call_next(*args)
+        finally:
+            self.histogram(args[-1]["header"]).observe(time.perf_counter() - started)
+
+    '''
+    Returns the histogram for a header, creating it the first time the header is handled
+    '''
+    def histogram(self, header: str):
+        histogram = self.histograms.get(header)
+
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.get(header)
+
+                if histogram is None:
+                    name = f"{self.prefix}_{header.replace('-', '_')}_seconds"
+                    histogram = self.histograms[header] = Metrics.histogram(name, f"Time taken to handle {header} packets")
+
+        return histogram
+
+'''
+SlowCallTracer Class
+- Middleware which keeps traces of the most recent handler calls which took longer than the threshold in seconds
+- Each trace records when the call finished, the header, how long it took and the thread it ran on
+- Only the last limit traces are kept, so a burst of slow calls cannot grow the memory used
+'''
+class SlowCallTracer:
+    def __init__(self, threshold: float, limit: int = 100):
+        self.threshold = threshold
+        self.traces = deque(maxlen = limit)
+
+    def __call__(self, call_next, *args):
+        started = time.perf_counter()
+
+        try:
+            call_next(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+
+            if elapsed >= self.threshold:
+                self.traces.append({
+                    "time": round(time.time(), 3),
+                    "header": args[-1]["header"],
+                    "seconds": round(elapsed, 6),
+                    "thread": current_thread().name
+                })
+
+    '''
+    Returns the slow call traces, oldest first
+    '''
+    def snapshot(self):
+        return list(self.traces)
+
+'''
+HandlerProfiler Class
+- Middleware which runs handler calls under cProfile while a capture is running and only checks an attribute
+otherwise, so it can stay installed in production and be switched on when needed
+- Only one call is profiled at a time, calls which arrive meanwhile run without the profiler so a capture never
+makes clients wait on each other
+- The lock is reentrant so a capture can be stopped from inside the call being profiled, which is the case when the
+stop comes in as a packet
+'''
+class HandlerProfiler:
+    def __init__(self):
+        self.profile = None
+        self.lock = RLock()
+
+    def __call__(self, call_next, *args):
+        profile = self.profile
+
+        if profile is None or not self.lock.acquire(blocking = False):
+            call_next(*args)
+            return
+
+        try:
+            profile.runcall(call_next, *args)
+        finally:
+            self.lock.release()
+
+    '''
+    Starts a new capture, throwing away any capture which was already running
+    '''
+    def start(self):
+        self.profile = cProfile.Profile()
+
+    '''
+    Stops the capture and returns the profile as text, or None if no capture was running
+    '''
+    def stop(self, limit: int = PROFILE_LIMIT, sort: str = PROFILE_SORT_KEYS[0]):
+        profile, self.profile = self.profile, None
+
+        if profile is None:
+            return None
+
+        # Waits for the call being profiled, if there is one, to finish
+        with self.lock:
+            pass
+
+        stream = io.StringIO()
+
+        try:
+            pstats.Stats(profile, stream = stream).sort_stats(sort).print_stats(limit)
+        except TypeError:
+            return ""
+
+        return stream.getvalue()
+
+    @property
+    def running(self):
+        return self.profile is not None
@@ -0,0 +1,130 @@
+
+from threading import Thread, Lock
+import asyncio
+import math
+import time
+
+'''
+TimerWheel Class
+- Hashed timing wheel, a ring of buckets where each bucket holds the items due on one tick
+- Scheduling an item and collecting the items due on a tick are both O(1) per item, no matter how many items
+are scheduled, so a single wheel can track every connection on the server
+- Delays longer than the wheel are cut down to the length of the wheel, the caller reschedules anything which is
+not due yet when its bucket comes around
+'''
+class TimerWheel:
+    def __init__(self, tick: float, slots: int):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.current = 0
+        self.lock = Lock()
+
+    '''
+    Schedules an item to be collected after roughly the given delay in seconds
+    '''
+    def schedule(self, item, delay: float):
+        ticks = min(max(1, math.ceil(delay / self.tick)), len(self.slots) - 1)
+
+        with self.lock:
+            self.slots[(self.current + ticks) % len(self.slots)].add(item)
+
+    '''
+    Moves the wheel on by one tick and returns every item which was scheduled for that tick
+    '''
+    def advance(self):
+        with self.lock:
+            self.current += 1
+            slot = self.current % len(self.slots)
+            items = self.slots[slot]
+            self.slots[slot] = set()
+
+        return items
+
+'''
+HeartbeatMonitor Class
+- Checks the liveness of every connected client with a single thread and a single timer wheel
+- A client which has sent nothing for the heartbeat interval is sent a ping, which it answers with a pong
+- A client which has sent nothing for the heartbeat timeout, pong included, is treated as disconnected
+- Clients only record the time they were last heard from, they are not moved around the wheel on every packet
+- The wheel is turned by a thread of its own, or by a task on the event loop for the asyncio server
+'''
+class HeartbeatMonitor:
+    def __init__(self, interval: float, timeout: float, on_ping, on_expire, tick: float = 1):
+        self.interval = interval
+        self.timeout = timeout
+        self.on_ping = on_ping
+        self.on_expire = on_expire
+        self.wheel = TimerWheel(tick, math.ceil(timeout / tick) + 2)
+        self.thread = Thread(target = self.run, daemon = True)
+
+    '''
+    Starts the thread which turns the wheel
+    '''
+    def start(self):
+        self.thread.start()
+
+    '''
+    Starts watching a newly connected client
+    '''
+    def add(self, client):
+        client.last_seen = time.monotonic()
+        client.pinged = False
+        self.wheel.schedule(client, self.interval)
+
+    '''
+    Records that a client has just been heard from
+    '''
+    def touch(self, client):
+        client.last_seen = time.monotonic()
+        client.pinged = False
+
+    '''
+    Turns the wheel once every tick and checks the clients which come due
+    '''
+    def run(self):
+        next_tick = time.monotonic()
+
+        while True:
+            next_tick += self.wheel.tick
+            time.sleep(max(0, next_tick - time.monotonic()))
+            self.turn()
+
+    '''
+    Turns the wheel from an event loop instead of a thread, so the clients are only ever pinged and expired on the
+    loop which owns them
+    '''
+    async def run_async(self):
+        next_tick = time.monotonic()
+
+        while True:
+            next_tick += self.wheel.tick
+            await asyncio.sleep(max(0, next_tick - time.monotonic()))
+            self.turn()
+
+    '''
+    Moves the wheel on by one tick and checks the clients which come due
+    '''
+    def turn(self):
+        for client in self.wheel.advance():
+            self.check(client)
+
+    '''
+    Pings, expires or reschedules a single client
+    - Clients which have already disconnected are simply dropped from the wheel
+    '''
+    def check(self, client):
+        if client.closed:
+            return
+
+        idle = time.monotonic() - client.last_seen
+
+        if idle >= self.timeout:
+            self.on_expire(client)
+        elif idle >= self.interval and not client.pinged:
+            client.pinged = True
+            self.on_ping(client)
+            self.wheel.schedule(client, self.timeout - idle)
+        elif client.pinged:
+            self.wheel.schedule(client, self.timeout - idle)
+        else:
+            self.wheel.schedule(client, self.interval - idle)
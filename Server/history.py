@@ -0,0 +1,111 @@
+
+from chatroom_objects import Message
+from threading import RLock
+
+'''
+MessageHistory Class
+- Bounded ring buffer which stores the most recent messages sent in the chat room
+- Once full, storing a new message overwrites the oldest one so memory use never grows past the capacity
+- Every stored message gets a sequence number so messages can be looked up by ID and paged through in O(1) + O(page)
+- Safe to use from every client thread at once
+'''
+class MessageHistory:
+    def __init__(self, capacity: int = 1000):
+        self.capacity = capacity
+        self.slots = [None] * capacity
+        self.sequences = {}
+        self.count = 0
+        self.lock = RLock()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def __iter__(self):
+        return iter(self.slice(self.first_sequence, self.count))
+
+    '''
+    The sequence number of the oldest message still stored
+    '''
+    @property
+    def first_sequence(self):
+        return max(0, self.count - self.capacity)
+
+    '''
+    Stores a message, returns the message which was evicted to make room for it if there was one
+    '''
+    def append(self, message: Message):
+        with self.lock:
+            slot = self.count % self.capacity
+            evicted = self.slots[slot]
+
+            if evicted is not None:
+                self.sequences.pop(evicted.id, None)
+
+            self.slots[slot] = message
+            self.sequences[message.id] = self.count
+            self.count += 1
+
+            return evicted
+
+    '''
+    Returns the stored message with the given ID, or None if it was never stored or has been evicted
+    '''
+    def get(self, message_id: int):
+        sequence = self.sequences.get(message_id)
+
+        if sequence is None:
+            return None
+
+        return self.slots[sequence % self.capacity]
+
+    '''
+    Returns the stored messages with sequence numbers in the range [start, end), oldest first
+    '''
+    def slice(self, start: int, end: int):
+        with self.lock:
+            start = max(start, self.first_sequence)
+            end = min(end, self.count)
+
+            return [self.slots[sequence % self.capacity] for sequence in range(start, end)]
+
+    '''
+    Returns the most recent messages, oldest first
+    '''
+    def last(self, limit: int):
+        return self.slice(self.count - limit, self.count)
+
+    '''
+    Returns up to limit messages which were sent before the message with the given ID, oldest first
+    - Nothing older is stored if the message has already been evicted
+    '''
+    def before(self, message_id: int, limit: int):
+        sequence = self.sequences.get(message_id)
+
+        if sequence is None:
+            return []
+
+        return self.slice(sequence - limit, sequence)
+
+    '''
+    Returns up to limit messages which were sent after the message with the given ID, oldest first
+    - Starts from the oldest stored message if the message has already been evicted
+    '''
+    def after(self, message_id: int, limit: int):
+        sequence = self.sequences.get(message_id)
+        start = self.first_sequence if sequence is None else sequence + 1
+
+        return self.slice(start, start + limit)
+
+    '''
+    Checks whether there are stored messages older than the given message
+    '''
+    def has_before(self, message: Message):
+        sequence = self.sequences.get(message.id)
+        return sequence is not None and sequence > self.first_sequence
+
+    '''
+    Checks whether there are stored messages newer than the given message
+    '''
+    def has_after(self, message: Message):
+        sequence = self.sequences.get(message.id)
+        return sequence is not None and sequence < self.count - 1
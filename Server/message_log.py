@@ -0,0 +1,335 @@
+
+from chatroom_objects import *
+from threading import Thread, Lock, Condition
+import struct
+import json
+import mmap
+import os
+
+'''
+Message log constants
+- RECORD_HEADER: Every record in a log segment starts with a 4 byte big endian length followed by the message JSON
+- INDEX_ENTRY: Every entry in an index file holds the message ID, the offset of the record in the segment and
+the length of the record, the Nth entry describes the Nth record of the segment
+- FIND_WINDOW: How many records either side of where a message ID should be are checked when looking it up, message
+IDs are handed out before messages are stored so messages sent at the same moment can be stored slightly out of order
+'''
+RECORD_HEADER = struct.Struct(">I")
+INDEX_ENTRY = struct.Struct(">QQI")
+FIND_WINDOW = 256
+
+'''
+LogSegment Class
+- A single log file and the index file which describes it
+- Segments are named after the sequence number of their first record so they sort in the order they were written
+'''
+class LogSegment:
+    def __init__(self, directory: str, base: int):
+        self.base = base
+        self.log_path = os.path.join(directory, f"{base:020d}.log")
+        self.index_path = os.path.join(directory, f"{base:020d}.index")
+        self.index_map = None
+        self.index_map_size = 0
+
+        for path in (self.log_path, self.index_path):
+            if not os.path.exists(path):
+                open(path, "wb").close()
+
+    '''
+    The amount of records stored in the segment
+    '''
+    def __len__(self):
+        return os.path.getsize(self.index_path) // INDEX_ENTRY.size
+
+    '''
+    The size of the segment's log file in bytes
+    '''
+    @property
+    def size(self):
+        return os.path.getsize(self.log_path)
+
+    '''
+    Returns the memory mapped index, the map is only recreated after the index has grown
+    '''
+    def index(self):
+        size = len(self) * INDEX_ENTRY.size
+
+        if size != self.index_map_size:
+            self.close()
+
+            if size:
+                with open(self.index_path, "rb") as file:
+                    self.index_map = mmap.mmap(file.fileno(), size, access = mmap.ACCESS_READ)
+
+            self.index_map_size = size
+
+        return self.index_map
+
+    '''
+    Returns the (id, offset, length) index entry of a record in the segment
+    '''
+    def entry(self, position: int):
+        return INDEX_ENTRY.unpack_from(self.index(), position * INDEX_ENTRY.size)
+
+    '''
+    Reads the records in the range [start, end) of the segment with a single read of their byte range
+    '''
+    def read(self, start: int, end: int):
+        if start >= end:
+            return []
+
+        first = self.entry(start)
+        last = self.entry(end - 1)
+
+        with open(self.log_path, "rb") as file:
+            file.seek(first[1])
+            data = file.read(last[1] + last[2] - first[1])
+
+        records = []
+
+        for position in range(start, end):
+            _, offset, length = self.entry(position)
+            offset -= first[1]
+            records.append(data[offset + RECORD_HEADER.size:offset + length])
+
+        return records
+
+    '''
+    Drops index entries and log bytes left behind by a write which was interrupted part way through
+    '''
+    def recover(self):
+        entries = len(self)
+
+        with open(self.index_path, "r+b") as file:
+            file.truncate(entries * INDEX_ENTRY.size)
+
+        log_size = self.size
+
+        while entries and sum(self.entry(entries - 1)[1:]) > log_size:
+            entries -= 1
+
+            with open(self.index_path, "r+b") as file:
+                file.truncate(entries * INDEX_ENTRY.size)
+
+        end = sum(self.entry(entries - 1)[1:]) if entries else 0
+
+        with open(self.log_path, "r+b") as file:
+            file.truncate(end)
+
+    '''
+    Releases the memory mapped index
+    '''
+    def close(self):
+        if self.index_map is not None:
+            self.index_map.close()
+            self.index_map = None
+
+        self.index_map_size = 0
+
+'''
+MessageLog Class
+- Durable, append only log of every message sent in the chat room
+- Split into segments so old history can be archived or deleted one file at a time
+- Appending only queues the message, a background thread writes and fsyncs every queued message at once
+(group commit) so disk latency is never added to the broadcast path
+- Indexes are memory mapped so recent history can be read straight from its byte range without replaying the log
+'''
+class MessageLog:
+    def __init__(self, directory: str, segment_size: int = 64 * 1024 * 1024, commit_interval: float = 0.05):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.commit_interval = commit_interval
+        self.segments = []
+        self.pending = []
+        self.lock = Lock()
+        self.pending_condition = Condition()
+        self.closed = False
+
+        os.makedirs(directory, exist_ok = True)
+
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".log"):
+                self.segments.append(LogSegment(directory, int(name[:-4])))
+
+        if self.segments:
+            self.segments[-1].recover()
+        else:
+            self.segments.append(LogSegment(directory, 0))
+
+        self.committer = Thread(target = self.commit_loop, daemon = True)
+        self.committer.start()
+
+    '''
+    The sequence number the next message written to the log will get
+    '''
+    @property
+    def count(self):
+        return self.segments[-1].base + len(self.segments[-1])
+
+    '''
+    Queues a message to be written to the log
+    - Returns straight away, the message is written by the next group commit
+    '''
+    def append(self, message: Message):
+        record = json.dumps(message.build_json()).encode()
+
+        with self.pending_condition:
+            self.pending.append((message.id, record))
+            self.pending_condition.notify()
+
+    '''
+    Writes queued messages to the log in batches
+    - Waits up to the commit interval so messages arriving close together share a single fsync
+    '''
+    def commit_loop(self):
+        while True:
+            with self.pending_condition:
+                while not self.pending and not self.closed:
+                    self.pending_condition.wait()
+
+                if not self.pending and self.closed:
+                    return
+
+                self.pending_condition.wait(self.commit_interval)
+                batch = self.pending
+                self.pending = []
+
+            self.commit(batch)
+
+    '''
+    Writes a batch of records to the active segment and fsyncs it
+    - The log is written before the index so an index entry never points at a record that is not on disk
+    '''
+    def commit(self, batch: list):
+        with self.lock:
+            segment = self.segments[-1]
+
+            if segment.size >= self.segment_size:
+                segment = LogSegment(self.directory, self.count)
+                self.segments.append(segment)
+
+            offset = segment.size
+            records = bytearray()
+            entries = bytearray()
+
+            for message_id, record in batch:
+                length = RECORD_HEADER.size + len(record)
+                records += RECORD_HEADER.pack(len(record)) + record
+                entries += INDEX_ENTRY.pack(message_id & 0xFFFFFFFFFFFFFFFF, offset, length)
+                offset += length
+
+            with open(segment.log_path, "ab") as file:
+                file.write(records)
+                file.flush()
+                os.fsync(file.fileno())
+
+            with open(segment.index_path, "ab") as file:
+                file.write(entries)
+                file.flush()
+                os.fsync(file.fileno())
+
+    '''
+    Reads the messages with sequence numbers in the range [start, end), oldest first
+    '''
+    def read(self, start: int, end: int):
+        messages = []
+
+        with self.lock:
+            for segment in self.segments:
+                segment_end = segment.base + len(segment)
+
+                if segment_end <= start or segment.base >= end:
+                    continue
+
+                first = max(start, segment.base) - segment.base
+                last = min(end, segment_end) - segment.base
+
+                for record in segment.read(first, last):
+                    messages.append(self.decode_record(record))
+
+        return messages
+
+    '''
+    Finds the sequence number of the message with the given ID, or None if it is not in the log
+    - Message IDs increase over time, so this is a binary search over the segments and then over the memory
+    mapped index of the segment which should hold the message
+    - IDs are only roughly in order, messages sent at the same moment, or on different workers of a cluster, can be
+    stored in a different order than their IDs were handed out, so the records within FIND_WINDOW of where the
+    search ends are checked, along with the segments either side in case the message landed across a boundary
+    '''
+    def find(self, message_id: int):
+        with self.lock:
+            segments = [segment for segment in self.segments if len(segment)]
+            low, high = 0, len(segments)
+
+            while low < high:
+                middle = (low + high) // 2
+
+                if segments[middle].entry(0)[0] <= message_id:
+                    low = middle + 1
+                else:
+                    high = middle
+
+            for segment in segments[max(0, low - 2):low + 1]:
+                position = self.find_in_segment(segment, message_id)
+
+                if position is not None:
+                    return segment.base + position
+
+            return None
+
+    '''
+    Finds the position of the message with the given ID within a single segment, or None if it is not there
+    - Must be called while holding the lock
+    '''
+    def find_in_segment(self, segment: LogSegment, message_id: int):
+        low, high = 0, len(segment)
+
+        while low < high:
+            middle = (low + high) // 2
+
+            if segment.entry(middle)[0] < message_id:
+                low = middle + 1
+            else:
+                high = middle
+
+        for position in range(max(0, low - FIND_WINDOW), min(len(segment), low + FIND_WINDOW)):
+            if segment.entry(position)[0] == message_id:
+                return position
+
+        return None
+
+    '''
+    Reads the most recent messages in the log, oldest first
+    - Used to reload history when the server starts
+    '''
+    def load_recent(self, limit: int):
+        end = self.count
+        return self.read(max(0, end - limit), end)
+
+    '''
+    Rebuilds a message from a record stored in the log
+    '''
+    def decode_record(self, record: bytes):
+        data = json.loads(record.decode())
+
+        sender = User.intern(data["sender"]["id"], data["sender"]["name"])
+        message = Message(data["content"], sender)
+        message.id = data["id"]
+        message.attachment = data.get("attachment")
+
+        return message
+
+    '''
+    Writes any queued messages and stops the background thread
+    '''
+    def close(self):
+        with self.pending_condition:
+            self.closed = True
+            self.pending_condition.notify()
+
+        self.committer.join()
+
+        with self.lock:
+            for segment in self.segments:
+                segment.close()
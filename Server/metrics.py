@@ -0,0 +1,185 @@
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Lock
+import bisect
+import time
+
+'''
+Default histogram buckets, in seconds, from 50 microseconds up to 5 seconds
+'''
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+'''
+Counter Class
+- A total which only ever goes up, such as the amount of bytes sent
+'''
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = Lock()
+
+    def increment(self, amount: int = 1):
+        with self.lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+    def prometheus(self):
+        return [f"{self.name} {self.value}"]
+
+'''
+Gauge Class
+- A value which is read from the server whenever the metrics are collected, such as the amount of connections
+- Costs nothing on the hot path since nothing is recorded until it is read
+'''
+class Gauge:
+    def __init__(self, name: str, help: str, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def snapshot(self):
+        return self.read()
+
+    def prometheus(self):
+        return [f"{self.name} {self.read()}"]
+
+'''
+Histogram Class
+- Counts observations into fixed buckets, such as how long broadcasts take
+- Only one in every sample_every calls is timed, callers ask the histogram whether to time a call with sampled()
+so the untimed calls never touch the clock
+'''
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: tuple = LATENCY_BUCKETS, sample_every: int = 1):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        self.sample_every = sample_every
+        self.calls = 0
+        self.lock = Lock()
+
+    '''
+    Returns whether the current call should be timed
+    - The call counter is not locked, a lost update only shifts which call gets sampled
+    '''
+    def sampled(self):
+        self.calls += 1
+        return self.calls % self.sample_every == 0
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def cumulative_counts(self):
+        with self.lock:
+            counts = list(self.counts)
+
+        total = 0
+
+        for index, count in enumerate(counts):
+            total += count
+            counts[index] = total
+
+        return counts
+
+    def snapshot(self):
+        counts = self.cumulative_counts()
+
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": {str(bound): count for bound, count in zip(self.buckets + ("+Inf",), counts)}
+        }
+
+    def prometheus(self):
+        lines = [f'{self.name}_bucket{{le="{bound}"}} {count}' for bound, count in zip(self.buckets + ("+Inf",), self.cumulative_counts())]
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {self.count}")
+
+        return lines
+
+'''
+Static class which holds every metric of the process
+- Metrics are created once, usually at import time, and then updated directly by the code they measure
+- Creating a metric with a name which is already taken replaces the old one
+'''
+class Metrics:
+    metrics = {}
+    started = time.monotonic()
+
+    @classmethod
+    def counter(cls, name: str, help: str):
+        metric = cls.metrics[name] = Counter(name, help)
+        return metric
+
+    @classmethod
+    def gauge(cls, name: str, help: str, read):
+        metric = cls.metrics[name] = Gauge(name, help, read)
+        return metric
+
+    @classmethod
+    def histogram(cls, name: str, help: str, buckets: tuple = LATENCY_BUCKETS, sample_every: int = 1):
+        metric = cls.metrics[name] = Histogram(name, help, buckets, sample_every)
+        return metric
+
+    '''
+    Returns the current value of every metric as a dictionary which can be sent in a packet
+    '''
+    @classmethod
+    def snapshot(cls):
+        return {
+            "uptime": round(time.monotonic() - cls.started, 3),
+            "metrics": {name: metric.snapshot() for name, metric in list(cls.metrics.items())}
+        }
+
+    '''
+    Returns every metric in the Prometheus text exposition format
+    '''
+    @classmethod
+    def prometheus(cls):
+        lines = []
+
+        for metric in list(cls.metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {type(metric).__name__.lower()}")
+            lines.extend(metric.prometheus())
+
+        return "\n".join(lines) + "\n"
+
+'''
+MetricsRequestHandler Class
+- Answers every GET request with the metrics in the Prometheus text format
+'''
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = Metrics.prometheus().encode()
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args):
+        pass
+
+'''
+Serves the metrics over HTTP from a background thread, returns the HTTP server
+'''
+def start_metrics_server(ip: str, port: int):
+    server = ThreadingHTTPServer((ip, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    Thread(target = server.serve_forever, daemon = True).start()
+
+    return server
@@ -1,21 +1,252 @@
 
-from threading import Thread, Lock
+from threading import Thread, RLock, Condition
+from collections import deque
+from wire_format import *
+from metrics import Metrics
 import socket
+import struct
 import json
+import zlib
 import time
 
+'''
+Frame constants
+- FRAME_HEADER: Every frame starts with a 4 byte big endian unsigned integer holding the length of the payload
+- MAX_FRAME_SIZE: Frames larger than this are treated as a broken connection instead of being buffered
+'''
+FRAME_HEADER = struct.Struct(">I")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+'''
+FrameBuffer class
+- Reassembles length prefixed frames from a stream of bytes
+- Handles frames which arrive split over several reads as well as several frames arriving in a single read
+'''
+class FrameBuffer:
+    def __init__(self):
+        self.buffer = bytearray()
+
+    '''
+    Appends received bytes to the buffer
+    '''
+    def feed(self, data: bytes):
+        self.buffer += data
+
+    '''
+    Removes and returns the next complete frame payload, or None if a full frame has not arrived yet
+    '''
+    def next_frame(self):
+        if len(self.buffer) < FRAME_HEADER.size:
+            return None
+
+        (length,) = FRAME_HEADER.unpack_from(self.buffer)
+
+        if length > MAX_FRAME_SIZE:
+            raise ConnectionError(f"Frame of {length} bytes exceeds the maximum frame size")
+
+        end = FRAME_HEADER.size + length
+
+        if len(self.buffer) < end:
+            return None
+
+        frame = bytes(self.buffer[FRAME_HEADER.size:end])
+        del self.buffer[:end]
+
+        return frame
+
+    '''
+    Prefixes a payload with its length so it can be sent as a single frame
+    '''
+    @staticmethod
+    def encode_frame(data: bytes):
+        return FRAME_HEADER.pack(len(data)) + data
+
+'''
+Compression constants
+- DEFLATE: The name of the only compression method, offered by the client in its user packet
+- COMPRESSED_MARKER: The first byte of a compressed payload, JSON and binary packets never start with it
+- SYNC_TRAILER: Every compressed payload ends with these bytes, they are left off and added back by the receiver
+'''
+DEFLATE = "deflate"
+COMPRESSED_MARKER = b"\xff"
+SYNC_TRAILER = b"\x00\x00\xff\xff"
+
+'''
+FrameCompressor class
+- Compresses the frames sent over a single connection with one deflate stream
+- The stream carries on across frames, so repeated names and IDs in later frames compress against earlier ones
+- Frames smaller than the threshold are sent as they are, they gain little from compression
+'''
+class FrameCompressor:
+    def __init__(self, threshold: int = 512):
+        self.threshold = threshold
+        self.compressor = zlib.compressobj(wbits = -zlib.MAX_WBITS)
+
+    '''
+    Returns the frame to send in place of the given frame
+    - Must always be called from the same thread, in the order frames are sent
+    '''
+    def compress_frame(self, frame: bytes):
+        if len(frame) - FRAME_HEADER.size < self.threshold:
+            return frame
+
+        payload = memoryview(frame)[FRAME_HEADER.size:]
+        data = self.compressor.compress(payload) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+        return FrameBuffer.encode_frame(COMPRESSED_MARKER + data[:-len(SYNC_TRAILER)])
+
+'''
+Networking metrics
+- Broadcast durations are only timed for one in every eight broadcasts
+'''
+BYTES_SENT = Metrics.counter("chatroom_bytes_sent_total", "Bytes written to client sockets")
+BYTES_RECEIVED = Metrics.counter("chatroom_bytes_received_total", "Bytes read from client sockets")
+FRAMES_SENT = Metrics.counter("chatroom_frames_sent_total", "Frames written to client sockets")
+PACKETS_RECEIVED = Metrics.counter("chatroom_packets_received_total", "Packets received from clients")
+DROPPED_PACKETS = Metrics.counter("chatroom_dropped_packets_total", "Packets discarded from the send queues of slow clients")
+BROADCAST_SECONDS = Metrics.histogram("chatroom_broadcast_seconds", "Time taken to queue a packet for every member of a room", sample_every = 8)
+
+'''
+Marker frame which replaces the queue of a client under the resync overflow policy
+'''
+RESYNC_FRAME = FrameBuffer.encode_frame(json.dumps({"header": "resync"}).encode())
+
+'''
+Send queue overflow policies
+- DROP_OLDEST: Discards the oldest queued packets until the queue is back down to the low watermark
+- DISCONNECT: Closes the connection of a client which has fallen too far behind
+- RESYNC: Discards every queued packet and replaces them with a single resync marker, once the marker has been
+sent the client is given a fresh copy of the chat room state
+'''
+DROP_OLDEST = "drop-oldest"
+DISCONNECT = "disconnect"
+RESYNC = "resync"
+
 '''
 Client class
 - Stores useful information about a client, such as the ip and socket
+- Owns a bounded outbound queue which is drained by a single writer thread
 '''
 class Client:
-    def __init__(self, ip: str, port: int, sock: socket.socket):
+    def __init__(self, ip: str, port: int, sock: socket.socket, high_watermark: int = 256, low_watermark: int = 64, overflow_policy: str = DROP_OLDEST):
         self.ip = ip
         self.port = port
         self.sock = sock
-        self.received_user = False
         self.user = None
-        self.sendlock = Lock()
+        self.rooms = set()
+        self.format = JSON
+        self.compressor = None
+        self.sendlock = RLock()
+        self.framebuffer = FrameBuffer()
+
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.overflow_policy = overflow_policy
+        self.outbound = deque()
+        self.outbound_condition = Condition(self.sendlock)
+        self.dropped_packets = 0
+        self.closed = False
+        self.on_resync = None
+        self.last_seen = time.monotonic()
+        self.pinged = False
+        self.resume = None
+        self.message_bucket = None
+        self.join_bucket = None
+        self.writer = Thread(target = self.writer_loop, daemon = True)
+        self.writer.start()
+
+    '''
+    The amount of packets waiting to be sent to the client
+    '''
+    @property
+    def queue_depth(self):
+        return len(self.outbound)
+
+    '''
+    Adds a frame to the outbound queue
+    - Never blocks, if the queue reaches the high watermark the overflow policy is applied
+    '''
+    def enqueue(self, frame: bytes):
+        with self.outbound_condition:
+            if self.closed:
+                return
+
+            self.outbound.append(frame)
+
+            if len(self.outbound) >= self.high_watermark:
+                self.apply_overflow_policy()
+
+            self.outbound_condition.notify()
+
+    '''
+    Deals with a client which is not reading packets as fast as they are being sent
+    - Must be called while holding the send lock
+    '''
+    def apply_overflow_policy(self):
+        dropped_packets = self.dropped_packets
+
+        if self.overflow_policy == DISCONNECT:
+            self.dropped_packets += len(self.outbound)
+            self.outbound.clear()
+            self.close()
+        elif self.overflow_policy == RESYNC:
+            self.dropped_packets += len(self.outbound)
+            self.outbound.clear()
+            self.outbound.append(RESYNC_FRAME)
+        else:
+            while len(self.outbound) > self.low_watermark:
+                self.outbound.popleft()
+                self.dropped_packets += 1
+
+        DROPPED_PACKETS.increment(self.dropped_packets - dropped_packets)
+
+    '''
+    Sends queued frames to the client one at a time
+    - The only place where data is written to the client's socket
+    - The lock is released while sending so queueing packets is never delayed by a slow socket
+    - Frames are compressed on the way out if the client asked for compression, so queued frames can still be shared
+    with other clients
+    '''
+    def writer_loop(self):
+        while True:
+            with self.outbound_condition:
+                while not self.outbound and not self.closed:
+                    self.outbound_condition.wait()
+
+                if self.closed:
+                    return
+
+                frame = self.outbound.popleft()
+
+            data = frame if self.compressor is None else self.compressor.compress_frame(frame)
+
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                with self.outbound_condition:
+                    self.outbound.clear()
+                    self.closed = True
+
+                return
+
+            BYTES_SENT.increment(len(data))
+            FRAMES_SENT.increment()
+
+            if frame is RESYNC_FRAME and self.on_resync:
+                self.on_resync(self)
+
+    '''
+    Stops the writer and shuts the socket down so the listener for this client notices the disconnection
+    '''
+    def close(self):
+        with self.outbound_condition:
+            self.closed = True
+            self.outbound_condition.notify()
+
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
 '''
 Static class used for transferring data over a network
@@ -23,65 +254,85 @@ Static class used for transferring data over a network
 class DataTransfer:
     '''
     Sends a dictionary packet to a client
-    - Serialises and encodes the packet and then sends it
+    - Encodes the packet in the wire format the client negotiated and then sends it
     '''
     @classmethod
     def send_packet(cls, client: Client, packet: dict):
-        serial = json.dumps(packet)
-        cls.send_data(client, serial.encode())
+        cls.send_data(client, WireFormat.encode(packet, client.format))
 
     '''
-    Opens a thread to send raw data to a client
+    Queues raw data to be sent to a client
+    - Returns straight away, the client's writer thread does the actual sending
     '''
     @classmethod
     def send_data(cls, client: Client, data: bytes):
-        Thread(target = cls._send_data, args = (client, data)).start()
+        cls.send_frame(client, FrameBuffer.encode_frame(data))
 
     '''
-    Receives a dictionary packet from a client
-    - Decodes and deserialises data received
+    Queues an already encoded frame to be sent to a client
     '''
     @classmethod
-    def recv_packet(cls, client: Client, bufferlen: int):
-        data = cls.recv_data(client, bufferlen)
-        return json.loads(data.decode())
+    def send_frame(cls, client: Client, frame: bytes):
+        client.enqueue(frame)
 
     '''
-    Receives a certain amount of bytes from a client
+    Encodes and frames a dictionary packet in the given wire format
+    - The result is immutable so it can be shared between every client it is sent to
     '''
     @classmethod
-    def recv_data(cls, client: Client, bufferlen: int):
-        return client.sock.recv(bufferlen)
+    def encode_packet(cls, packet: dict, format: str = JSON):
+        return FrameBuffer.encode_frame(WireFormat.encode(packet, format))
+
+    '''
+    Sends a dictionary packet to many clients
+    - The packet is only encoded once for each wire format in use, every client using that format is queued the
+    same frame
+    '''
+    @classmethod
+    def broadcast_packet(cls, clients: list, packet: dict):
+        started = time.perf_counter() if BROADCAST_SECONDS.sampled() else None
+        frames = {}
+
+        for client in clients:
+            frame = frames.get(client.format)
+
+            if frame is None:
+                frame = frames[client.format] = cls.encode_packet(packet, client.format)
+
+            cls.send_frame(client, frame)
+
+        if started is not None:
+            BROADCAST_SECONDS.observe(time.perf_counter() - started)
 
     '''
-    Sends data to a client in a thread safe manner
-    - Ensures data sending is synced between all the threads calling it
-    - Allows the receiver to receive data one packet at a time to prevent overlapping packets
-    - Only locks each client's socket, there is no universal lock for the clients
-    - Allows for a max of 10 packets per second to be sent to a client
+    Receives a dictionary packet from a client
+    - Decodes data received in either wire format
     '''
     @classmethod
-    def _send_data(cls, client: Client, data: bytes):
-        client.sendlock.acquire()
-        time.sleep(0.1)
-        client.sock.send(data)
-        client.sendlock.release()
+    def recv_packet(cls, client: Client, bufferlen: int):
+        data = cls.recv_data(client, bufferlen)
+        PACKETS_RECEIVED.increment()
+
+        return WireFormat.decode(data)
 
     '''
-    Checks to see if a socket is connected or not
-    - Tries to send a dummy packet to the socket, if it failed it is not connected
+    Receives a single frame from a client
+    - Keeps reading up to bufferlen bytes at a time until a complete frame has been buffered
+    - Any extra bytes received after the frame stay buffered for the next call
+    - Raises ConnectionError once the client closes the connection
     '''
     @classmethod
-    def socket_is_connected(cls, sock: socket.socket):
-        packet = {
-            "header": "connection-test"
-        }
+    def recv_data(cls, client: Client, bufferlen: int):
+        while True:
+            frame = client.framebuffer.next_frame()
 
-        serial = json.dumps(packet)
+            if frame is not None:
+                return frame
 
-        try:
-            sock.send(serial.encode())
-            return True
-        except:
-            return False
+            data = client.sock.recv(bufferlen)
+
+            if not data:
+                raise ConnectionError("Connection closed by client")
 
+            BYTES_RECEIVED.increment(len(data))
+            client.framebuffer.feed(data)
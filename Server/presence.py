@@ -0,0 +1,84 @@
+
+from chatroom_objects import *
+from threading import Thread, Lock
+import time
+
+'''
+PresenceAggregator Class
+- Collects the users which join and leave each room and hands them over in batches, once per window
+- A single thread flushes every room with pending changes, so the members of a room are told about any amount of
+joins and leaves with one roster diff and one announcement per window, a reconnect storm of N users costs O(N)
+packets instead of O(N²)
+- A user which joins and leaves within the same window is only reported as leaving
+- A window of 0 flushes every change straight away
+'''
+class PresenceAggregator:
+    def __init__(self, window: float, on_flush):
+        self.window = window
+        self.on_flush = on_flush
+        self.pending = {}
+        self.lock = Lock()
+        self.thread = Thread(target = self.run, daemon = True)
+
+    '''
+    Starts the thread which flushes the pending changes, nothing is started if changes are flushed straight away
+    '''
+    def start(self):
+        if self.window > 0:
+            self.thread.start()
+
+    '''
+    Records a user joining a room
+    '''
+    def joined(self, room, user: User):
+        with self.lock:
+            joined, left = self.changes(room)
+            joined[user.id] = user
+
+        if self.window <= 0:
+            self.flush()
+
+    '''
+    Records a user leaving a room
+    '''
+    def left(self, room, user: User):
+        with self.lock:
+            joined, left = self.changes(room)
+            joined.pop(user.id, None)
+            left[user.id] = user
+
+        if self.window <= 0:
+            self.flush()
+
+    '''
+    Returns the users which joined and left a room during the current window, by ID
+    - Must be called while holding the lock
+    '''
+    def changes(self, room):
+        changes = self.pending.get(room)
+
+        if changes is None:
+            changes = self.pending[room] = ({}, {})
+
+        return changes
+
+    '''
+    Flushes the pending changes once every window
+    '''
+    def run(self):
+        next_flush = time.monotonic()
+
+        while True:
+            next_flush += self.window
+            time.sleep(max(0, next_flush - time.monotonic()))
+            self.flush()
+
+    '''
+    Hands the changes of every room over to on_flush(room, joined, left) and starts a new window
+    '''
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        for room, (joined, left) in pending.items():
+            self.on_flush(room, joined, left)
@@ -0,0 +1,57 @@
+
+from threading import Lock
+import time
+
+'''
+Rate limit policies, what happens to a client which goes over its own limit
+- LIMIT_DROP: The packet is ignored and the client is told it was rate limited
+- LIMIT_DELAY: The client's packets stop being read until it is allowed to send again, which pushes back on the
+client through TCP instead of dropping anything
+- LIMIT_DISCONNECT: The client is disconnected and its rooms are told why
+'''
+LIMIT_DROP = "drop"
+LIMIT_DELAY = "delay"
+LIMIT_DISCONNECT = "disconnect"
+
+'''
+TokenBucket Class
+- Allows a steady rate of events per second, plus bursts of up to the bucket's capacity
+- Tokens are refilled lazily from the time since the last check, so checking the bucket is O(1) and needs no timer
+'''
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    '''
+    Takes tokens from the bucket if there are enough, returns whether the event is allowed
+    '''
+    def consume(self, tokens: float = 1):
+        with self.lock:
+            self.refill()
+
+            if self.tokens < tokens:
+                return False
+
+            self.tokens -= tokens
+            return True
+
+    '''
+    How many seconds until the bucket will hold enough tokens for an event
+    '''
+    def wait_time(self, tokens: float = 1):
+        with self.lock:
+            self.refill()
+            return max(0, (tokens - self.tokens) / self.rate)
+
+    '''
+    Adds the tokens earned since the last refill, up to the capacity of the bucket
+    - Must be called while holding the lock
+    '''
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
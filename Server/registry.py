@@ -0,0 +1,128 @@
+
+from chatroom_objects import *
+from threading import Lock
+import json
+
+'''
+ClientRegistry Class
+- Stores every connected client, indexed by connection and by the ID of the client's user
+- Adding, removing and looking up a client are all O(1)
+- Keeps an encoded roster of every user which is updated as users join and leave, so sending the users to a new
+client never has to build a packet for each user again
+- Registries belonging to a room include the room's name in the users packet
+'''
+class ClientRegistry:
+    def __init__(self, room: str = None):
+        self.room = room
+        self.connections = {}
+        self.users = {}
+        self.roster = {}
+        self.roster_packet = None
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.connections)
+
+    def __contains__(self, client):
+        return client in self.connections
+
+    '''
+    Iterates over a snapshot of the connected clients so other threads can connect and disconnect meanwhile
+    '''
+    def __iter__(self):
+        with self.lock:
+            return iter(tuple(self.connections))
+
+    '''
+    Registers a newly connected client
+    '''
+    def add(self, client):
+        with self.lock:
+            self.connections[client] = None
+
+    '''
+    Removes a client and its user from the registry
+    - Returns False if the client had already been removed
+    '''
+    def remove(self, client):
+        with self.lock:
+            if client not in self.connections:
+                return False
+
+            del self.connections[client]
+
+            if client.user is not None and self.users.get(client.user.id) is client:
+                del self.users[client.user.id]
+                del self.roster[client.user.id]
+                self.roster_packet = None
+
+            return True
+
+    '''
+    Indexes a client by the ID of its user and adds the user to the roster
+    '''
+    def add_user(self, client, user: User):
+        with self.lock:
+            self.users[user.id] = client
+            self.roster[user.id] = json.dumps(user.build_packet())
+            self.roster_packet = None
+
+    '''
+    Adds a user which is connected to a different server in the cluster to the roster
+    '''
+    def add_remote_user(self, user: User):
+        with self.lock:
+            self.roster[user.id] = json.dumps(user.build_packet())
+            self.roster_packet = None
+
+    '''
+    Removes a user which is connected to a different server in the cluster from the roster
+    '''
+    def remove_remote_user(self, user_id: int):
+        with self.lock:
+            if user_id not in self.users and self.roster.pop(user_id, None) is not None:
+                self.roster_packet = None
+
+    '''
+    The amount of users in the roster
+    '''
+    @property
+    def user_count(self):
+        return len(self.roster)
+
+    '''
+    Checks that there are no connected clients and no users in the roster
+    '''
+    def is_empty(self):
+        return not self.connections and not self.roster
+
+    '''
+    Returns the client whose user has the given ID, or None if there isn't one
+    '''
+    def get(self, user_id: int):
+        return self.users.get(user_id)
+
+    '''
+    Returns a users-diff packet, already serialised and encoded, which brings a client that knew about the given
+    user IDs up to date
+    - Lists the users which joined since as well as the IDs of the users which left since
+    '''
+    def roster_diff_data(self, known_ids: set):
+        with self.lock:
+            added = [data for user_id, data in self.roster.items() if user_id not in known_ids]
+            removed = [user_id for user_id in known_ids if user_id not in self.roster]
+
+        room = "" if self.room is None else f'"room": {json.dumps(self.room)}, '
+        return ('{"header": "users-diff", ' + room + '"added": [' + ", ".join(added) + '], "removed": ' + json.dumps(removed) + "}").encode()
+
+    '''
+    Returns the users packet listing every user in the roster, already serialised and encoded
+    - Only rebuilt after a user joins or leaves, and then only by joining the already encoded users together
+    '''
+    def roster_data(self):
+        with self.lock:
+            if self.roster_packet is None:
+                room = "" if self.room is None else f'"room": {json.dumps(self.room)}, '
+                self.roster_packet = ('{"header": "users", ' + room + '"array": [' + ", ".join(self.roster.values()) + "]}").encode()
+
+            return self.roster_packet
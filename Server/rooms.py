@@ -0,0 +1,132 @@
+
+from chatroom_objects import *
+from history import MessageHistory
+from message_log import MessageLog
+from registry import ClientRegistry
+from search import SearchIndex
+
+'''
+Room constants
+- DEFAULT_ROOM: The room every client joins when it connects, it is never removed
+'''
+DEFAULT_ROOM = "general"
+
+'''
+Room Class
+- A single chat room hosted by the server with its own members and its own history
+- Broadcasts for a room only go to the room's members, so the cost of a broadcast depends on the size of the room
+rather than the amount of clients connected to the server
+'''
+class Room:
+    def __init__(self, name: str, history_capacity: int, log_directory: str = None):
+        self.name = name
+        self.members = ClientRegistry(name)
+        self.messages = MessageHistory(history_capacity)
+        self.search_index = SearchIndex()
+        self.page_frames = {}
+        self.message_log = None
+        self.message_bucket = None
+        self.join_bucket = None
+
+        if log_directory is not None:
+            self.message_log = MessageLog(log_directory)
+
+            for message in self.message_log.load_recent(history_capacity):
+                self.remember_message(message)
+
+    '''
+    Stores a message sent in the room in its history and its message log
+    '''
+    def store_message(self, message: Message):
+        self.remember_message(message)
+
+        if self.message_log is not None:
+            self.message_log.append(message)
+
+    '''
+    Adds a message to the in memory history and the search index
+    - The message evicted from the history to make room is removed from the search index as well
+    - The message is indexed before it is stored, so a message which cannot be indexed is not stored either
+    '''
+    def remember_message(self, message: Message):
+        self.search_index.add(message)
+        evicted = self.messages.append(message)
+
+        if evicted is not None:
+            self.search_index.remove(evicted)
+
+    '''
+    Searches the in memory history, returns a page of matching messages, newest first, and whether there are more
+    '''
+    def search(self, query: str, limit: int, before: int = None):
+        message_ids, more = self.search_index.search(query, limit, before)
+        messages = [self.messages.get(message_id) for message_id in message_ids]
+
+        return [message for message in messages if message is not None], more
+
+    '''
+    Returns up to limit messages sent before the message with the given ID, and whether there are even older ones
+    - Messages are read from the in memory history first, the message log is used for anything older than that
+    '''
+    def messages_before(self, message_id: int, limit: int):
+        messages = self.messages.before(message_id, limit)
+
+        if len(messages) == limit or self.message_log is None or not isinstance(message_id, int):
+            return messages, bool(messages) and self.has_older_messages(messages[0])
+
+        sequence = self.message_log.find(messages[0].id if messages else message_id)
+
+        if sequence is None:
+            return messages, False
+
+        start = max(0, sequence - (limit - len(messages)))
+        return self.message_log.read(start, sequence) + messages, start > 0
+
+    '''
+    Returns the messages sent after the message with the given ID, oldest first, for a client catching up after it
+    reconnected
+    - Message IDs are time ordered, so the message does not have to be in memory, or even in this room
+    - Returns None if more than limit messages were missed or some of them are no longer in memory, the client has to
+    be sent the latest page instead
+    '''
+    def messages_after(self, message_id: int, limit: int):
+        if self.messages.get(message_id) is not None:
+            messages = self.messages.after(message_id, limit + 1)
+        else:
+            oldest = self.messages.slice(self.messages.first_sequence, self.messages.first_sequence + 1)
+
+            if oldest and oldest[0].id > message_id:
+                return None
+
+            messages = [message for message in self.messages.last(limit + 1) if message.id > message_id]
+
+        return None if len(messages) > limit else messages
+
+    '''
+    Checks whether there are messages older than the given message, either in memory or in the message log
+    '''
+    def has_older_messages(self, message: Message):
+        if self.messages.has_before(message):
+            return True
+
+        if self.message_log is None:
+            return False
+
+        sequence = self.message_log.find(message.id)
+        return sequence is not None and sequence > 0
+
+    '''
+    Builds the packet describing the room for a room-list
+    '''
+    def build_json(self):
+        return {
+            "name": self.name,
+            "members": self.members.user_count
+        }
+
+    '''
+    Writes any queued messages to the message log and closes it
+    '''
+    def close(self):
+        if self.message_log is not None:
+            self.message_log.close()
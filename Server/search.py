@@ -0,0 +1,144 @@
+
+from chatroom_objects import Message
+from threading import Lock
+import bisect
+import re
+
+'''
+Search constants
+- SENDER_PREFIX: Query terms starting with this match the name of the sender instead of the content
+- PREFIX_WILDCARD: Query terms ending with this match every term which starts with the rest of the query term
+- MAX_QUERY_TERMS: Any terms past this many in a single query are ignored
+'''
+SENDER_PREFIX = "from:"
+PREFIX_WILDCARD = "*"
+MAX_QUERY_TERMS = 8
+
+WORD = re.compile(r"\w+")
+
+'''
+SearchIndex Class
+- Inverted index which maps every term to the IDs of the messages containing it
+- Updated as messages are stored and evicted, so a search never has to scan the history
+- The postings for a term are kept in the order messages were stored, so results come out newest first without
+sorting, and evicting the oldest message only ever removes entries from the front
+- A sorted list of every term is kept alongside, so prefix queries are a binary search followed by a range
+'''
+class SearchIndex:
+    def __init__(self):
+        self.postings = {}
+        self.terms = []
+        self.lock = Lock()
+
+    '''
+    Splits text into lowercase terms
+    '''
+    @staticmethod
+    def tokenize(text: str):
+        return WORD.findall(text.lower())
+
+    '''
+    Returns every term a message is indexed under, its content words and its sender
+    '''
+    def message_terms(self, message: Message):
+        terms = set(self.tokenize(message.content))
+        terms.add(SENDER_PREFIX + message.sender.name.lower())
+
+        return terms
+
+    '''
+    Indexes a newly stored message
+    '''
+    def add(self, message: Message):
+        with self.lock:
+            for term in self.message_terms(message):
+                postings = self.postings.get(term)
+
+                if postings is None:
+                    postings = self.postings[term] = {}
+                    bisect.insort(self.terms, term)
+
+                postings[message.id] = None
+
+    '''
+    Removes a message which has been evicted from the history
+    '''
+    def remove(self, message: Message):
+        with self.lock:
+            for term in self.message_terms(message):
+                postings = self.postings.get(term)
+
+                if postings is None:
+                    continue
+
+                postings.pop(message.id, None)
+
+                if not postings:
+                    del self.postings[term]
+                    del self.terms[bisect.bisect_left(self.terms, term)]
+
+    '''
+    Returns the IDs of the messages matching a single query term as a dictionary in the order they were stored
+    - Exact terms return their postings as they are, nothing is copied
+    - Must be called while holding the lock
+    '''
+    def match(self, term: str):
+        if not term.endswith(PREFIX_WILDCARD):
+            return self.postings.get(term, {})
+
+        prefix = term[:-len(PREFIX_WILDCARD)]
+        start = bisect.bisect_left(self.terms, prefix)
+        end = bisect.bisect_left(self.terms, prefix + "\U0010ffff")
+        ids = set()
+
+        for term in self.terms[start:end]:
+            if prefix.startswith(SENDER_PREFIX) or not term.startswith(SENDER_PREFIX):
+                ids.update(self.postings[term])
+
+        return dict.fromkeys(sorted(ids))
+
+    '''
+    Finds the messages matching every term of a query, returns a page of message IDs, newest first, and whether
+    there are more matches after the page
+    - before: Only messages with an ID lower than this are returned, used to fetch the next page
+    - The query term with the fewest matches is walked and checked against the others, so the cost depends on the
+    rarest term rather than the size of the history
+    '''
+    def search(self, query: str, limit: int, before: int = None):
+        terms = self.parse_query(query)
+
+        if not terms:
+            return [], False
+
+        with self.lock:
+            matches = sorted((self.match(term) for term in terms), key = len)
+            page = []
+
+            for message_id in reversed(matches[0]):
+                if before is not None and message_id >= before:
+                    continue
+
+                if all(message_id in ids for ids in matches[1:]):
+                    if len(page) == limit:
+                        return page, True
+
+                    page.append(message_id)
+
+        return page, False
+
+    '''
+    Splits a query into terms, keeping the sender prefix and the prefix wildcard which tokenize would strip
+    '''
+    def parse_query(self, query: str):
+        terms = []
+
+        for word in query.lower().split()[:MAX_QUERY_TERMS]:
+            wildcard = PREFIX_WILDCARD if word.endswith(PREFIX_WILDCARD) else ""
+
+            if word.startswith(SENDER_PREFIX):
+                name = word[len(SENDER_PREFIX):].rstrip(PREFIX_WILDCARD)
+                terms.append(SENDER_PREFIX + name + wildcard)
+            else:
+                terms.extend(token + wildcard for token in self.tokenize(word))
+
+        return [term for term in terms if term.rstrip(PREFIX_WILDCARD)]
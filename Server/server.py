@@ -1,36 +1,155 @@
 
 from chatroom_objects import *
 from networking import *
-from threading import Thread
+from registry import ClientRegistry
+from rooms import *
+from conversations import *
+from attachments import *
+from heartbeat import HeartbeatMonitor
+from presence import PresenceAggregator
+from dispatch import *
+from rate_limiting import *
+from metrics import Metrics, start_metrics_server
+from threading import Thread, Lock
+import logging
 import socket
+import time
+import os
+
+'''
+Server metrics
+- Packet handling is only timed for one in every sixteen packets
+'''
+CONNECTIONS_TOTAL = Metrics.counter("chatroom_connections_total", "Connections accepted since the server started")
+MESSAGES_RECEIVED = Metrics.counter("chatroom_messages_total", "Chat messages accepted from clients")
+DIRECT_MESSAGES_RECEIVED = Metrics.counter("chatroom_direct_messages_total", "Direct messages accepted from clients")
+PACKET_SECONDS = Metrics.histogram("chatroom_packet_seconds", "Time taken to handle a packet received from a client", sample_every = 16)
+HANDLER_ERRORS = Metrics.counter("chatroom_handler_errors_total", "Packets dropped because their handler raised an exception")
+
+log = logging.getLogger(__name__)
+
+'''
+Packet types which are handled before a client has sent its user
+'''
+ANONYMOUS_HEADERS = ("ping", "user", "stats", "profile")
 
 '''
 ChatRoomServer Class, simple server which handles chat room events
+- Hosts any amount of rooms, every client joins the default room when it connects
 '''
 class ChatRoomServer(socket.socket):
-    def __init__(self, ip: str, port: int):
+    def __init__(self, ip: str, port: int, history_capacity: int = 1000, log_directory: str = None, reuse_port: bool = False, attachment_directory: str = None):
         super().__init__(socket.AF_INET, socket.SOCK_STREAM)
+        self.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        if reuse_port:
+            self.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
         self.bind((ip, port))
         self.listen(5)
 
         self.ip = ip
         self.port = port
-        self.clients = []
-        self.messages = []
-        self.attachments = {}
+        self.clients = ClientRegistry()
+        self.history_capacity = history_capacity
+        self.history_page_size = 50
+        self.resume_message_limit = 200
+        self.search_page_size = 20
+        self.log_directory = log_directory
+        self.rooms = {}
+        self.closing_rooms = {}
+        self.rooms_lock = Lock()
+        self.conversations = ConversationStore(100)
+        self.attachments = None if attachment_directory is None else AttachmentStore(attachment_directory)
+        self.transfers = None
+        self.transfer_port = 0
+        self.transfer_rate = None
+
+        self.message_rate = 5
+        self.message_burst = 10
+        self.join_rate = 1
+        self.join_burst = 5
+        self.room_message_rate = 50
+        self.room_message_burst = 100
+        self.room_join_rate = 10
+        self.room_join_burst = 20
+        self.rate_limit_policy = LIMIT_DROP
+
+        self.rooms[DEFAULT_ROOM] = self.create_room(DEFAULT_ROOM)
+
+        self.send_queue_high_watermark = 256
+        self.send_queue_low_watermark = 64
+        self.send_queue_policy = DROP_OLDEST
+        self.compression_threshold = 512
+        self.heartbeat_interval = 15
+        self.heartbeat_timeout = 45
+        self.heartbeat = None
+        self.presence = PresenceAggregator(0.25, self.broadcast_presence)
+        self.handler_timing = False
+        self.slow_call_threshold = None
+        self.slow_calls = None
+        self.profiler = HandlerProfiler()
+        self.dispatcher = PacketDispatcher()
+        self.register_handlers()
+        self.metrics_ip = "127.0.0.1"
+        self.metrics_port = None
+        self.metrics_server = None
 
         self.validate_user = lambda user: len(user.name) < 16
-        self.validate_message = lambda message: len(message.content) < 128
+        self.validate_message = lambda message: isinstance(message.content, str) and len(message.content) < 128
+        self.validate_room = lambda name: isinstance(name, str) and 0 < len(name) < 32 and name.replace("-", "").replace("_", "").isalnum()
+        self.validate_query = lambda query: isinstance(query, str) and 0 < len(query) < 128
+        self.validate_attachment_size = lambda size: isinstance(size, int) and 0 < size <= 64 * 1024 * 1024
+        self.validate_attachment_name = lambda name: isinstance(name, str) and 0 < len(name) < 64
+        self.validate_recipients = lambda recipients: isinstance(recipients, list) and 0 < len(recipients) <= MAX_RECIPIENTS and all(isinstance(user_id, int) for user_id in recipients)
+        self.validate_conversation = lambda participants: isinstance(participants, list) and 0 < len(participants) <= MAX_RECIPIENTS + 1 and all(isinstance(user_id, int) for user_id in participants)
+        self.validate_admin = lambda client: client.ip in ("127.0.0.1", "::1")
+
+        Metrics.gauge("chatroom_connections", "Clients currently connected", lambda: len(self.clients))
+        Metrics.gauge("chatroom_rooms", "Rooms currently open", lambda: len(self.rooms))
+        Metrics.gauge("chatroom_conversations", "Direct message conversations currently held", lambda: len(self.conversations))
+        Metrics.gauge("chatroom_send_queue_depth", "Packets waiting in every send queue", lambda: sum(client.queue_depth for client in self.clients))
+        Metrics.gauge("chatroom_send_queue_depth_max", "Packets waiting in the longest send queue", lambda: max((client.queue_depth for client in self.clients), default = 0))
 
     '''
     Starts the server
     - Begins listening for clients and opens a new thread when one connects
+    - Starts the heartbeat monitor which pings idle clients and disconnects dead ones
+    - Starts flushing the joins and leaves collected by the presence aggregator
+    - Serves the metrics over HTTP if a metrics port has been set
+    - Accepts attachment transfers on a port of their own if attachments are stored, the transfer port defaults to
+    any free port since clients are told which port to use with every transfer
+    - Times every packet type if handler timing is on, and traces handler calls slower than the slow call threshold
+    if one has been set
     '''
     def start(self):
+        if self.handler_timing:
+            self.dispatcher.use(HandlerTimer())
+
+        if self.slow_call_threshold is not None:
+            self.slow_calls = SlowCallTracer(self.slow_call_threshold)
+            self.dispatcher.use(self.slow_calls)
+
+        if self.metrics_port is not None:
+            self.metrics_server = start_metrics_server(self.metrics_ip, self.metrics_port)
+
+        if self.attachments is not None:
+            self.transfers = TransferServer(self.ip, self.transfer_port, self.attachments, self.attachment_uploaded, self.transfer_rate)
+            self.transfers.start()
+
+        self.heartbeat = HeartbeatMonitor(self.heartbeat_interval, self.heartbeat_timeout, self.ping_client, self.disconnect_client)
+        self.heartbeat.start()
+        self.presence.start()
+
         while True:
             conn, addr = self.accept()
-            client = Client(addr[0], addr[1], conn)
-            self.clients.append(client)
+            client = Client(addr[0], addr[1], conn, self.send_queue_high_watermark, self.send_queue_low_watermark, self.send_queue_policy)
+            client.on_resync = self.resync_client
+            client.message_bucket = TokenBucket(self.message_rate, self.message_burst)
+            client.join_bucket = TokenBucket(self.join_rate, self.join_burst)
+            self.clients.add(client)
+            self.heartbeat.add(client)
+            CONNECTIONS_TOTAL.increment()
 
             Thread(target = self.socket_listener, args = (client,)).start()
 
@@ -39,120 +158,836 @@ class ChatRoomServer(socket.socket):
     - Function which receives packets from a client and processes them
     - Each client is supposed to have their own thread running like this
     - Thread exits automatically once the client disconnects
+    - A packet whose handler raises is logged and dropped, the client's other packets are still handled
     '''
     def socket_listener(self, client: Client):
         while True:
             try:
                 packet = DataTransfer.recv_packet(client, 4096)
-            except:
-                if not DataTransfer.socket_is_connected(client.sock):
-                    self.clients.remove(client)
-                    self.broadcast_leave(client.user)
-                    self.broadcast_announcement(Announcement(f"{client.user.name} Has Left"))
-                    break
+            except OSError:
+                self.disconnect_client(client)
+                break
+            except Exception:
+                continue
+
+            self.heartbeat.touch(client)
+            started = time.perf_counter() if PACKET_SECONDS.sampled() else None
+
+            try:
+                self.dispatcher.dispatch(client, packet)
+            except Exception:
+                HANDLER_ERRORS.increment()
+                log.exception("Dropped a packet from %s:%s whose handler raised", client.ip, client.port)
+
+            if started is not None:
+                PACKET_SECONDS.observe(time.perf_counter() - started)
+
+    '''
+    Registers the handler for every packet type a client can send, and the middleware every packet goes through
+    - Handlers are called with the client and the packet, more can be registered on the dispatcher before the
+    server starts
+    - Pongs have no handler, hearing from a client at all is what the heartbeat needs
+    '''
+    def register_handlers(self):
+        self.dispatcher.use(self.require_user)
+        self.dispatcher.use(self.profiler)
+
+        self.dispatcher.register("ping", self.send_pong)
+        self.dispatcher.register("user", self.receive_user)
+        self.dispatcher.register("stats", self.receive_stats)
+        self.dispatcher.register("profile", self.receive_profile)
+        self.dispatcher.register("message", self.receive_message)
+        self.dispatcher.register("direct-message", self.send_direct_message)
+        self.dispatcher.register("history", self.send_history)
+        self.dispatcher.register("direct-history", self.send_direct_history)
+        self.dispatcher.register("attachment-upload", self.start_upload)
+        self.dispatcher.register("attachment-download", self.start_download)
+        self.dispatcher.register("search", self.send_search_results)
+        self.dispatcher.register("room-join", self.receive_room_join)
+        self.dispatcher.register("room-leave", self.receive_room_leave)
+        self.dispatcher.register("room-list", lambda client, packet: self.send_rooms(client))
+
+    '''
+    Middleware which drops packets from clients which have not sent their user yet, apart from the packet types
+    which do not need one
+    '''
+    def require_user(self, call_next, client: Client, packet: dict):
+        if client.user is not None or packet["header"] in ANONYMOUS_HEADERS:
+            call_next(client, packet)
+
+    def send_pong(self, client: Client, packet: dict):
+        packet = {
+            "header": "pong"
+        }
+
+        DataTransfer.send_packet(client, packet)
+
+    '''
+    Accepts the user sent by a newly connected client, along with the wire format and compression it asked for
+    - packet["resume"]: Sent by a client which is reconnecting, see resume_client
+    - A client only has one user per connection, any user sent after the first accepted one is ignored
+    '''
+    def receive_user(self, client: Client, packet: dict):
+        if client.user is not None or not self.rate_limit(client, client.join_bucket):
+            return
+
+        user = User.from_packet(packet)
+
+        if self.validate_user(user):
+            user.id = ObjectIDGenerator.generate_id()
+            User.register(user)
+            client.user = user
+            client.format = BINARY if BINARY in packet.get("formats", []) else JSON
+            client.resume = packet["resume"] if isinstance(packet.get("resume"), dict) else None
+
+            if DEFLATE in packet.get("compression", []):
+                client.compressor = FrameCompressor(self.compression_threshold)
+            self.clients.add_user(client, user)
+            self.join_room(client, DEFAULT_ROOM)
+
+    '''
+    Accepts a message sent in one of the client's rooms and publishes it
+    - packet["room"]: The room to send the message in, defaults to the default room
+    '''
+    def receive_message(self, client: Client, packet: dict):
+        message = Message(packet["content"], client.user)
+        room = self.rooms.get(packet.get("room", DEFAULT_ROOM))
+
+        if room is None or client not in room.members or not self.validate_message(message) or not self.attach(message, packet):
+            return
+
+        if self.rate_limit(client, client.message_bucket) and self.room_rate_limit(client, room.message_bucket):
+            message.id = ObjectIDGenerator.generate_id()
+            MESSAGES_RECEIVED.increment()
+            self.publish_message(message, room)
+
+    '''
+    Adds a client to the room it asked for, creating the room if it does not exist yet
+    '''
+    def receive_room_join(self, client: Client, packet: dict):
+        if not self.validate_room(packet.get("room")) or not self.rate_limit(client, client.join_bucket):
+            return
+
+        with self.rooms_lock:
+            room = self.rooms.get(packet["room"])
+
+        if room is None or self.room_rate_limit(client, room.join_bucket):
+            self.join_room(client, packet["room"])
+
+    def receive_room_leave(self, client: Client, packet: dict):
+        if packet.get("room") in client.rooms:
+            self.leave_room(client, packet["room"])
+
+    def receive_stats(self, client: Client, packet: dict):
+        if self.validate_admin(client):
+            self.send_stats(client)
+
+    '''
+    Starts or stops a cProfile capture of the packet handlers, so the packet type using the most CPU can be found on
+    a running server
+    - packet["action"]: "start" begins a new capture, "stop" ends it and sends the profile back as text
+    - packet["sort"]: The order to print the profile in, one of PROFILE_SORT_KEYS, defaults to cumulative time
+    - packet["limit"]: The most functions to print, defaults to PROFILE_LIMIT
+    '''
+    def receive_profile(self, client: Client, packet: dict):
+        if not self.validate_admin(client):
+            return
+
+        response = {
+            "header": "profile"
+        }
+
+        if packet.get("action") == "start":
+            self.profiler.start()
+        elif packet.get("action") == "stop":
+            sort = packet.get("sort") if packet.get("sort") in PROFILE_SORT_KEYS else PROFILE_SORT_KEYS[0]
+            limit = packet.get("limit") if isinstance(packet.get("limit"), int) else PROFILE_LIMIT
+            response["stats"] = self.profiler.stop(limit, sort)
+
+        response["running"] = self.profiler.running
+        DataTransfer.send_packet(client, response)
+
+    '''
+    Checks one of a client's own rate limits, returns whether the packet should be handled
+    - Applies the server's rate limit policy to a client which has gone over the limit
+    '''
+    def rate_limit(self, client: Client, bucket: TokenBucket):
+        if bucket.consume():
+            return True
+
+        if self.rate_limit_policy == LIMIT_DELAY:
+            time.sleep(bucket.wait_time())
+            return bucket.consume()
+
+        if self.rate_limit_policy == LIMIT_DISCONNECT:
+            self.disconnect_flooding_client(client)
+            return False
+
+        self.send_rate_limited(client, bucket)
+        return False
+
+    '''
+    Checks a room's rate limit, returns whether the packet should be handled
+    - A room going over its limit is not the fault of any one client, so the packet is only dropped
+    '''
+    def room_rate_limit(self, client: Client, bucket: TokenBucket):
+        if bucket.consume():
+            return True
+
+        self.send_rate_limited(client, bucket)
+        return False
+
+    '''
+    Tells a client that its packet was dropped and how long to wait before sending again
+    '''
+    def send_rate_limited(self, client: Client, bucket: TokenBucket):
+        packet = {
+            "header": "rate-limited",
+            "retry-after": round(bucket.wait_time(), 3)
+        }
+
+        DataTransfer.send_packet(client, packet)
+
+    '''
+    Disconnects a client which went over its rate limit, telling its rooms why it was removed
+    '''
+    def disconnect_flooding_client(self, client: Client):
+        if client.user is not None:
+            for name in list(client.rooms):
+                room = self.rooms.get(name)
+
+                if room is not None:
+                    self.broadcast_announcement(Announcement(f"{client.user.name} Was Disconnected For Flooding"), room)
+
+        self.disconnect_client(client)
+
+    '''
+    Removes a client which has disconnected
+    - Every way a client can go away ends up here, whether its connection dropped, it stopped answering heartbeats
+    or it fell too far behind
+    - Safe to call more than once, the client is only removed and the leave is only broadcast the first time
+    '''
+    def disconnect_client(self, client: Client):
+        if not self.clients.remove(client):
+            return
+
+        client.close()
+        client.sock.close()
+
+        if client.user is not None:
+            self.conversations.remove_user(client.user.id)
+
+        for name in list(client.rooms):
+            self.leave_room(client, name)
+
+    '''
+    Sends a ping to a client which has been quiet for the heartbeat interval, the client answers with a pong
+    '''
+    def ping_client(self, client: Client):
+        packet = {
+            "header": "ping"
+        }
+
+        DataTransfer.send_packet(client, packet)
+
+    '''
+    Sends a fresh copy of the chat room state to a client whose send queue was collapsed into a resync marker
+    '''
+    def resync_client(self, client: Client):
+        for name in list(client.rooms):
+            room = self.rooms.get(name)
+
+            if room is not None:
+                self.send_users(client, room)
+                self.send_messages(client, room)
+
+    '''
+    Returns the directory a room's message log is stored in, or None if messages are not being logged
+    - The default room is logged straight into the log directory, every other room gets a directory of its own
+    '''
+    def room_log_directory(self, name: str):
+        if self.log_directory is None:
+            return None
+
+        if name == DEFAULT_ROOM:
+            return self.log_directory
+
+        return os.path.join(self.log_directory, "rooms", name)
+
+    '''
+    Adds a client to a room, creating the room if it does not exist yet
+    '''
+    def join_room(self, client: Client, name: str):
+        with self.rooms_lock:
+            room = self.get_room(name)
+
+            if client in room.members:
+                return
+
+            room.members.add(client)
+            client.rooms.add(name)
+
+        self.publish_join(client.user, room)
+
+    '''
+    Removes a client from a room
+    '''
+    def leave_room(self, client: Client, name: str):
+        with self.rooms_lock:
+            room = self.rooms.get(name)
+            client.rooms.discard(name)
+
+            if room is None or not room.members.remove(client):
+                return
+
+        self.publish_leave(client.user, room)
+
+    '''
+    Returns the room with the given name, creating it if it does not exist yet
+    - Must be called while holding the rooms lock
+    '''
+    def get_room(self, name: str):
+        room = self.rooms.get(name)
+
+        if room is None:
+            room = self.rooms[name] = self.create_room(name)
+
+        return room
+
+    '''
+    Creates a room along with its rate limits
+    - A room of the same name which is still writing out its message log is waited for first, so the new room loads
+    every message the old one stored
+    '''
+    def create_room(self, name: str):
+        closing = self.closing_rooms.get(name)
+
+        if closing is not None:
+            closing.close()
+
+        room = Room(name, self.history_capacity, self.room_log_directory(name))
+        room.message_bucket = TokenBucket(self.room_message_rate, self.room_message_burst)
+        room.join_bucket = TokenBucket(self.room_join_rate, self.room_join_burst)
+
+        return room
+
+    '''
+    Closes a room once nobody is in it anymore, the default room is never closed
+    - The room is removed under the rooms lock but its message log is flushed after releasing it, so joins and room
+    lists never wait on the disk
+    '''
+    def close_room_if_empty(self, room: Room):
+        with self.rooms_lock:
+            if room.name == DEFAULT_ROOM or not room.members.is_empty() or self.rooms.get(room.name) is not room:
+                return
+
+            del self.rooms[room.name]
+            self.closing_rooms[room.name] = room
+
+        room.close()
+
+        with self.rooms_lock:
+            if self.closing_rooms.get(room.name) is room:
+                del self.closing_rooms[room.name]
+
+    '''
+    Publishes events which every member of a room has to be told about
+    - A single server applies them straight away, a clustered server sends them through the bus first so every
+    worker applies them in the same order
+    '''
+    def publish_join(self, user: User, room: Room):
+        self.user_joined(user, room)
+
+    def publish_leave(self, user: User, room: Room):
+        self.user_left(user, room)
+
+    def publish_message(self, message: Message, room: Room):
+        self.message_sent(message, room)
+
+    def publish_direct_message(self, message: Message, participants: tuple):
+        self.direct_message_sent(message, participants)
+
+    '''
+    Applies a user joining a room
+    - The room's members are told about the new user by the presence aggregator, together with every other user which
+    joins or leaves during the same window
+    - If the user is connected to this server, they are sent their own user and the room's users and messages, their
+    own user goes first so the client can tell itself apart in any roster diff which follows
+    - A client which is resuming after reconnecting is only sent what changed while it was away
+    '''
+    def user_joined(self, user: User, room: Room):
+        client = self.clients.get(user.id)
+
+        if client is None or client not in room.members:
+            room.members.add_remote_user(user)
+            self.presence.joined(room, user)
+            return
 
-            if packet["header"] == "user":
-                user = User.from_packet(packet)
-                client.received_user = True
+        self.send_own_user(client, room)
+        self.presence.joined(room, user)
+        resume, client.resume = client.resume, None
 
-                if self.validate_user(user):
-                    user.id = ObjectIDGenerator.generate_id()
-                    client.user = user
-                    self.broadcast_user(user)
-                    self.broadcast_announcement(Announcement(f"{user.name} Has Joined"))
+        if resume is not None:
+            self.resume_client(client, room, resume)
+            return
 
-                    if len(self.clients) > 1:
-                        self.send_users(client)
+        if room.members.user_count:
+            self.send_users(client, room)
 
-                    if len(self.messages):
-                        self.send_messages(client)
-            elif packet["header"] == "message":
-                message = Message.from_packet(packet)
+        room.members.add_user(client, user)
 
-                if self.validate_message(message):
-                    message.id = ObjectIDGenerator.generate_id()
-                    self.messages.append(message)
-                    self.broadcast_message(message)
+        if len(room.messages):
+            self.send_messages(client, room)
 
     '''
-    Tells all clients that a new user has connected
-    - packet["is-me"] becomes true if the client being sent the packet is the new user
+    Brings a reconnected client up to date with a room
+    - resume["users"]: The IDs of the users the client already knows about, it is sent a diff of the roster
+    - resume["last-message"]: The ID of the newest message the client already has, it is sent only the messages after
+    it, or the latest page if too many were missed
     '''
-    def broadcast_user(self, user: User):
-        for client in self.clients:
-            packet = user.build_packet()
+    def resume_client(self, client: Client, room: Room, resume: dict):
+        known_ids = resume.get("users")
+        last_message = resume.get("last-message")
 
-            if client.user.id == user.id:
-                packet["is-me"] = True
+        if isinstance(known_ids, list):
+            DataTransfer.send_data(client, room.members.roster_diff_data({user_id for user_id in known_ids if isinstance(user_id, int)}))
+        elif room.members.user_count:
+            self.send_users(client, room)
+
+        room.members.add_user(client, client.user)
+        messages = room.messages_after(last_message, self.resume_message_limit) if isinstance(last_message, int) else None
+
+        if messages is None:
+            if len(room.messages):
+                self.send_messages(client, room)
+        elif messages:
+            packet = {
+                "header": "history",
+                "room": room.name,
+                "after": last_message,
+                "array": [message.build_packet() for message in messages],
+                "more": False
+            }
 
             DataTransfer.send_packet(client, packet)
 
     '''
-    Tells all clients that a new message has been sent
+    Applies a user leaving a room
+    - The room's remaining members are told by the presence aggregator, the room is closed if it is now empty
+    '''
+    def user_left(self, user: User, room: Room):
+        room.members.remove_remote_user(user.id)
+
+        self.presence.left(room, user)
+        self.close_room_if_empty(room)
+
+    '''
+    Applies a message being sent in a room
+    '''
+    def message_sent(self, message: Message, room: Room):
+        room.store_message(message)
+        self.broadcast_message(message, room)
+
     '''
-    def broadcast_message(self, message: Message):
+    Applies a direct message being sent
+    - Only the participants connected to this server are looked up, each by the ID of its user, so a direct message
+    costs the same however many clients are connected and never goes through a room broadcast
+    - The message is stored in the conversation's own history, it is never written to a room's history or log
+    '''
+    def direct_message_sent(self, message: Message, participants: tuple):
+        clients = [client for client in map(self.clients.get, participants) if client is not None]
+
+        if not clients:
+            return
+
+        self.conversations.store(participants, message, [client.user.id for client in clients])
+
         packet = message.build_packet()
+        packet["header"] = "direct-message"
+        packet["conversation"] = list(participants)
+        frames = {}
 
-        for client in self.clients:
-            DataTransfer.send_packet(client, packet)
+        for client in clients:
+            frame = frames.get(client.format)
+
+            if frame is None:
+                frame = frames[client.format] = DataTransfer.encode_packet(packet, client.format)
+
+            DataTransfer.send_frame(client, frame)
+
+    '''
+    Checks whether the user with the given ID is connected, the sender of a direct message is told which recipients
+    were not
+    '''
+    def user_online(self, user_id: int):
+        return self.clients.get(user_id) is not None
 
     '''
-    Tells all clients that a client has disconnected
+    Tells all members of a room about the users which joined and left it during the last presence window
+    - Every member is sent one users-diff packet, which clients apply to the users they already have, and at most one
+    announcement for the joins and one for the leaves, however many users came and went
+    - Members which joined during the window were already sent the room's users, the users-diff repeats some of them
+    and clients skip users they already have
     '''
-    def broadcast_leave(self, user: User):
+    def broadcast_presence(self, room: Room, joined: dict, left: dict):
         packet = {
-            "header": "user-leave",
-            "user": user.build_json()
+            "header": "users-diff",
+            "room": room.name,
+            "added": [user.build_packet() for user in joined.values()],
+            "removed": list(left)
         }
 
-        for client in self.clients:
-            DataTransfer.send_packet(client, packet)
+        DataTransfer.broadcast_packet(room.members, packet)
+
+        if len(joined) == 1:
+            self.broadcast_announcement(Announcement(f"{next(iter(joined.values())).name} Has Joined"), room)
+        elif joined:
+            self.broadcast_announcement(Announcement(f"{len(joined)} Users Joined"), room)
+
+        if len(left) == 1:
+            self.broadcast_announcement(Announcement(f"{next(iter(left.values())).name} Has Left"), room)
+        elif left:
+            self.broadcast_announcement(Announcement(f"{len(left)} Users Left"), room)
+
+    '''
+    Tells all members of a room that a new message has been sent in it
+    '''
+    def broadcast_message(self, message: Message, room: Room):
+        packet = message.build_packet()
+        packet["room"] = room.name
+
+        DataTransfer.broadcast_packet(room.members, packet)
 
     '''
-    Announces information to each client
+    Announces information to each member of a room
     '''
-    def broadcast_announcement(self, announcement: Announcement):
+    def broadcast_announcement(self, announcement: Announcement, room: Room):
         packet = announcement.build_packet()
+        packet["room"] = room.name
 
-        for client in self.clients:
-            DataTransfer.send_packet(client, packet)
+        DataTransfer.broadcast_packet(room.members, packet)
 
     '''
-    Sends every connected user to a client
-    - Useful is a client is not the first to connect, they will be sent this
+    Sends a client its own user once it has joined a room, packet["is-me"] tells the client which user is its own
     '''
-    def send_users(self, client: Client):
-        users = []
+    def send_own_user(self, client: Client, room: Room):
+        packet = client.user.build_packet()
+        packet["room"] = room.name
+        packet["is-me"] = True
+
+        DataTransfer.send_packet(client, packet)
 
-        for _client in self.clients:
-            if _client != client and _client.received_user:
-                users.append(_client.user.build_packet())
+    '''
+    Sends every user in a room to a client
+    - Useful is a client is not the first to join a room, they will be sent this
+    - Sent before the client's own user is added to the room's roster, so the client is not told about itself
+    '''
+    def send_users(self, client: Client, room: Room):
+        DataTransfer.send_data(client, room.members.roster_data())
+
+    '''
+    Sends the most recent page of a room's messages to a client
+    - Useful if a client joins a room later on and needs to be told what the previous messages were
+    - Only the last page is sent, the client can ask for older messages with a history packet
+    - The encoded page is cached on the room for each wire format until the next message is stored, so a wave of
+    joins encodes the page once rather than once per client
+    '''
+    def send_messages(self, client: Client, room: Room):
+        count = room.messages.count
+        cached = room.page_frames.get(client.format)
+
+        if cached is None or cached[0] != count:
+            messages = room.messages.last(self.history_page_size)
+
+            packet = {
+                "header": "messages",
+                "room": room.name,
+                "array": [message.build_packet() for message in messages],
+                "more": bool(messages) and room.has_older_messages(messages[0])
+            }
+
+            cached = room.page_frames[client.format] = (count, DataTransfer.encode_packet(packet, client.format))
+
+        DataTransfer.send_frame(client, cached[1])
+
+    '''
+    Sends the name and member count of every room to a client
+    '''
+    def send_rooms(self, client: Client):
+        with self.rooms_lock:
+            rooms = [room.build_json() for room in self.rooms.values()]
 
         packet = {
-            "header": "users",
-            "array": users
+            "header": "room-list",
+            "array": rooms
         }
 
         DataTransfer.send_packet(client, packet)
 
     '''
-    Sends every message to a client
-    - Useful if a client connects later on in the chat and needs to be told what the previous messages were
+    Sends a page of the messages in a room which match a search query
+    - packet["query"]: Words which must all appear in a message, "from:name" matches the sender and a word ending in
+    "*" matches every word starting with it
+    - packet["room"]: The room to search, defaults to the default room, the client must be a member
+    - packet["before"]: Only matches older than the message with this ID are sent, used to fetch the next page
+    - Only the messages still held in memory are searched
+    '''
+    def send_search_results(self, client: Client, packet: dict):
+        room = self.rooms.get(packet.get("room", DEFAULT_ROOM))
+        query = packet.get("query")
+        before = packet.get("before")
+
+        if room is None or client not in room.members or not self.validate_query(query):
+            return
+
+        messages, more = room.search(query, self.search_page_size, before if isinstance(before, int) else None)
+
+        response = {
+            "header": "search",
+            "room": room.name,
+            "query": query,
+            "array": [message.build_packet() for message in messages],
+            "more": more
+        }
+
+        if isinstance(before, int):
+            response["before"] = before
+
+        DataTransfer.send_packet(client, response)
+
+    '''
+    Sends a private message from a client to one or more other users
+    - packet["recipients"]: The IDs of the users to send the message to, the sender is added to the conversation
+    - packet["ref"]: Any value chosen by the client, it is sent back in the acknowledgement so the client can tell which
+    message it is for
+    - The sender is acknowledged with the ID given to the message and the recipients which were not online to
+    receive it, their copy is kept in the conversation's history for as long as the sender is connected
+    '''
+    def send_direct_message(self, client: Client, packet: dict):
+        recipients = packet.get("recipients")
+
+        if not self.validate_recipients(recipients):
+            return
+
+        message = Message(packet["content"], client.user)
+        participants = Conversation.key(recipients + [client.user.id])
+
+        if len(participants) < 2 or not self.validate_message(message) or not self.attach(message, packet):
+            return
+
+        if not self.rate_limit(client, client.message_bucket):
+            return
+
+        message.id = ObjectIDGenerator.generate_id()
+        undelivered = [user_id for user_id in participants if not self.user_online(user_id)]
+        DIRECT_MESSAGES_RECEIVED.increment()
+        self.publish_direct_message(message, participants)
+
+        ack = {
+            "header": "direct-message-ack",
+            "ref": packet.get("ref"),
+            "id": message.id,
+            "conversation": list(participants),
+            "undelivered": undelivered
+        }
+
+        DataTransfer.send_packet(client, ack)
+
+    '''
+    Sends a page of a conversation's messages to one of its participants
+    - packet["conversation"]: The IDs of the conversation's participants, as sent with every direct message
+    - packet["before"]: Sends the messages sent before the message with this ID, otherwise the most recent ones
+    - packet["limit"]: How many messages the client wants, capped to the history page size
     '''
-    def send_messages(self, client: Client):
+    def send_direct_history(self, client: Client, packet: dict):
+        participants = packet.get("conversation")
+
+        if not self.validate_conversation(participants):
+            return
+
+        participants = Conversation.key(participants)
+
+        if client.user.id not in participants:
+            return
+
+        conversation = self.conversations.get(participants)
+        limit = self.history_limit(packet)
         messages = []
 
-        for message in self.messages:
-            messages.append(message.build_packet())
+        response = {
+            "header": "direct-history",
+            "conversation": list(participants)
+        }
+
+        if conversation is not None and "before" in packet:
+            messages = conversation.messages.before(packet["before"], limit)
+            response["before"] = packet["before"]
+        elif conversation is not None:
+            messages = conversation.messages.last(limit)
+
+        response["array"] = [message.build_packet() for message in messages]
+        response["more"] = bool(messages) and conversation.messages.has_before(messages[0])
+        DataTransfer.send_packet(client, response)
+
+    '''
+    Attaches the attachment a message packet refers to, returns False if the store does not have it
+    - packet["attachment"]: The hash and file name of an uploaded attachment, its size is filled in from the store
+    '''
+    def attach(self, message: Message, packet: dict):
+        if "attachment" not in packet:
+            return True
+
+        data = packet["attachment"]
+
+        if self.attachments is None or not isinstance(data, dict) or not self.validate_attachment_name(data.get("name")):
+            return False
+
+        size = self.attachments.size(data["hash"]) if AttachmentStore.is_hash(data.get("hash")) else None
+
+        if size is None:
+            return False
+
+        message.attachment = {
+            "hash": data["hash"],
+            "name": data["name"],
+            "size": size
+        }
+
+        return True
+
+    '''
+    Starts or resumes the upload of an attachment
+    - packet["hash"]: The hex SHA-256 of the file, which the attachment is stored and referred to by
+    - packet["size"]: The size of the file in bytes
+    - A file which the store already has is not sent again, the client is told it was uploaded straight away
+    - Otherwise the client is granted a transfer, the offset in the grant is how much of an interrupted upload of the
+    same file the store already has
+    '''
+    def start_upload(self, client: Client, packet: dict):
+        digest = packet.get("hash")
+        size = packet.get("size")
+
+        if self.transfers is None or not AttachmentStore.is_hash(digest) or not self.validate_attachment_size(size):
+            return
+
+        stored = self.attachments.size(digest)
+
+        if stored is not None:
+            self.attachment_uploaded(client, digest, stored)
+        else:
+            self.send_transfer(client, UPLOAD, digest, size, min(self.attachments.received(digest), size))
+
+    '''
+    Starts or resumes the download of an attachment
+    - packet["hash"]: The hash of the attachment, as given in the message it was attached to
+    - packet["offset"]: How many bytes of the file the client already has, defaults to 0
+    - The client is told if the store does not have the attachment
+    '''
+    def start_download(self, client: Client, packet: dict):
+        digest = packet.get("hash")
+        offset = packet.get("offset", 0)
+
+        if self.transfers is None or not AttachmentStore.is_hash(digest) or not isinstance(offset, int):
+            return
+
+        size = self.attachments.size(digest)
+
+        if size is not None and 0 <= offset <= size:
+            self.send_transfer(client, DOWNLOAD, digest, size, offset)
+            return
 
         packet = {
-            "header": "messages",
-            "array": messages
+            "header": "attachment-missing",
+            "hash": digest
         }
 
         DataTransfer.send_packet(client, packet)
 
+    '''
+    Grants a client a transfer and tells it which port and token to open the transfer connection with
+    '''
+    def send_transfer(self, client: Client, kind: str, digest: str, size: int, offset: int):
+        packet = {
+            "header": "attachment-transfer",
+            "kind": kind,
+            "hash": digest,
+            "size": size,
+            "offset": offset,
+            "port": self.transfers.port,
+            "token": self.transfers.grant(client, kind, digest, size)
+        }
+
+        DataTransfer.send_packet(client, packet)
+
+    '''
+    Tells a client that its attachment has been stored and can be attached to messages
+    '''
+    def attachment_uploaded(self, client: Client, digest: str, size: int):
+        packet = {
+            "header": "attachment-uploaded",
+            "hash": digest,
+            "size": size
+        }
+
+        DataTransfer.send_packet(client, packet)
+
+    '''
+    Sends the current value of every metric to an admin client, along with the slow call traces if they are kept
+    '''
+    def send_stats(self, client: Client):
+        packet = Metrics.snapshot()
+        packet["header"] = "stats"
+
+        if self.slow_calls is not None:
+            packet["slow-calls"] = self.slow_calls.snapshot()
+
+        DataTransfer.send_packet(client, packet)
+
+    '''
+    Sends a page of a room's messages which a client asked for
+    - packet["room"]: The room to send messages from, defaults to the default room, the client must be a member
+    - packet["before"]: Sends the messages sent before the message with this ID, older messages which are no longer
+    in memory are read from the message log
+    - packet["after"]: Sends the messages sent after the message with this ID
+    - Neither: Sends the most recent messages
+    - packet["limit"]: How many messages the client wants, capped to the history page size
+    '''
+    def send_history(self, client: Client, packet: dict):
+        room = self.rooms.get(packet.get("room", DEFAULT_ROOM))
+
+        if room is None or client not in room.members:
+            return
+
+        limit = self.history_limit(packet)
+
+        response = {
+            "header": "history",
+            "room": room.name
+        }
+
+        if "before" in packet:
+            messages, response["more"] = room.messages_before(packet["before"], limit)
+            response["before"] = packet["before"]
+        elif "after" in packet:
+            messages = room.messages.after(packet["after"], limit)
+            response["after"] = packet["after"]
+            response["more"] = bool(messages) and room.messages.has_after(messages[-1])
+        else:
+            messages = room.messages.last(limit)
+            response["more"] = bool(messages) and room.has_older_messages(messages[0])
+
+        response["array"] = [message.build_packet() for message in messages]
+        DataTransfer.send_packet(client, response)
+
+    '''
+    Returns how many messages a history request asked for, capped to the history page size
+    '''
+    def history_limit(self, packet: dict):
+        try:
+            return max(1, min(int(packet.get("limit", self.history_page_size)), self.history_page_size))
+        except (TypeError, ValueError):
+            return self.history_page_size
+
 if __name__ == "__main__":
     server = ChatRoomServer(socket.gethostname(), 1024)
     server.start()
-